@@ -0,0 +1,194 @@
+''' Compact archive of bus localizations with independently readable hour blocks.
+
+The archive starts with a header (magic bytes, number of blocks and for each block
+its hour, offset and length) followed by zlib compressed blocks. Every block holds
+the tracks of all vehicles from one hour: repeated samples are dropped, times are
+delta encoded seconds and coordinates are delta encoded fixed-point integers.
+'''
+import json
+import os
+import struct
+import zlib
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+
+MAGIC = b'WBA1'
+HEADER = struct.Struct('<4sI')
+INDEX_ENTRY = struct.Struct('<IQQ')
+BLOCK_HEADER = struct.Struct('<I')
+COORDINATE_SCALE = 10 ** 7 # about 1 cm of precision
+COLUMNS = ['Lines', 'Lon', 'VehicleNumber', 'Time', 'Lat', 'Brigade']
+TRACK_KEY = ['VehicleNumber', 'Lines', 'Brigade']
+
+def encode_hour(localizations: pd.DataFrame) -> bytes:
+    '''
+    Encode localizations from one hour as a compressed block.
+
+    :param localizations: DataFrame with bus localizations.
+
+    '''
+    data = localizations[COLUMNS].copy()
+    data[TRACK_KEY] = data[TRACK_KEY].astype(str)
+    data['Seconds'] = pd.to_datetime(data['Time'], format='%Y-%m-%d %H:%M:%S') \
+                        .values.astype('datetime64[s]').astype(np.int64)
+    data = data.sort_values(TRACK_KEY + ['Seconds'], kind='stable')
+    # the same sample is repeated in consecutive polls until the vehicle reports again
+    data = data.drop_duplicates(TRACK_KEY + ['Seconds'])
+
+    tracks = data.groupby(TRACK_KEY, sort=False).size()
+    strings: Dict[str, List[str]] = {}
+    codes = []
+    for i, column in enumerate(TRACK_KEY):
+        column_codes, uniques = pd.factorize(tracks.index.get_level_values(i))
+        strings[column] = list(uniques)
+        codes.append(column_codes.astype(np.int32))
+
+    seconds = data['Seconds'].values
+    lat = np.round(data['Lat'].values * COORDINATE_SCALE).astype(np.int64)
+    lon = np.round(data['Lon'].values * COORDINATE_SCALE).astype(np.int64)
+    header = json.dumps({'strings': strings, 'tracks': len(tracks), 'samples': len(data)})
+    header = header.encode('utf-8')
+
+    payload = b''.join([
+        BLOCK_HEADER.pack(len(header)), header,
+        *(column_codes.tobytes() for column_codes in codes),
+        tracks.values.astype(np.int32).tobytes(),
+        np.diff(seconds, prepend=0).astype(np.int64).tobytes(),
+        np.diff(lat, prepend=0).astype(np.int32).tobytes(),
+        np.diff(lon, prepend=0).astype(np.int32).tobytes(),
+    ])
+    return zlib.compress(payload, 9)
+
+def decode_hour(block: bytes) -> pd.DataFrame:
+    '''
+    Decode localizations from a compressed block.
+
+    :param block: Block made by encode_hour.
+
+    '''
+    payload = zlib.decompress(block)
+    header_length, = BLOCK_HEADER.unpack_from(payload)
+    position = BLOCK_HEADER.size + header_length
+    header = json.loads(payload[BLOCK_HEADER.size:position].decode('utf-8'))
+
+    def read(dtype, count: int) -> np.ndarray:
+        nonlocal position
+        array = np.frombuffer(payload, dtype=dtype, count=count, offset=position)
+        position += array.nbytes
+        return array
+
+    codes = [read(np.int32, header['tracks']) for _ in TRACK_KEY]
+    lengths = read(np.int32, header['tracks'])
+    seconds = np.cumsum(read(np.int64, header['samples']))
+    lat = np.cumsum(read(np.int32, header['samples']), dtype=np.int64) / COORDINATE_SCALE
+    lon = np.cumsum(read(np.int32, header['samples']), dtype=np.int64) / COORDINATE_SCALE
+
+    data = {}
+    for column, column_codes in zip(TRACK_KEY, codes):
+        values = np.array(header['strings'][column], dtype=object)
+        data[column] = np.repeat(values[column_codes], lengths)
+    data['Lat'] = lat
+    data['Lon'] = lon
+    data['Time'] = pd.to_datetime(seconds, unit='s').strftime('%Y-%m-%d %H:%M:%S')
+    return pd.DataFrame(data, columns=COLUMNS)
+
+def read_index(path: str) -> Dict[int, Tuple[int, int]]:
+    '''
+    Read the offsets and lengths of hour blocks in the archive.
+
+    :param path: Path to the archive.
+
+    '''
+    with open(path, 'rb') as f:
+        magic, blocks = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a localization archive')
+        index = {}
+        for _ in range(blocks):
+            hour, offset, length = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+            index[hour] = (offset, length)
+    return index
+
+def read_hour(path: str, hour: int) -> pd.DataFrame:
+    '''
+    Read localizations from the given hour without decoding the other hours.
+
+    :param path: Path to the archive.
+
+    :param hour: Hour of the day.
+
+    '''
+    offset, length = read_index(path)[hour]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return decode_hour(f.read(length))
+
+def write_blocks(path: str, blocks: Dict[int, bytes]):
+    '''
+    Write compressed hour blocks to the archive.
+
+    :param path: Path to the archive.
+
+    :param blocks: Compressed blocks for each hour.
+
+    '''
+    hours = sorted(blocks)
+    offset = HEADER.size + INDEX_ENTRY.size * len(hours)
+    index = []
+    for hour in hours:
+        index.append(INDEX_ENTRY.pack(hour, offset, len(blocks[hour])))
+        offset += len(blocks[hour])
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(hours)))
+        f.write(b''.join(index))
+        for hour in hours:
+            f.write(blocks[hour])
+    os.replace(tmp_path, path)
+
+def add_hour(path: str, hour: int, localizations: pd.DataFrame):
+    '''
+    Add localizations from the given hour to the archive, replacing the hour if present.
+
+    Blocks of the other hours are copied without decoding.
+
+    :param path: Path to the archive.
+
+    :param hour: Hour of the day.
+
+    :param localizations: DataFrame with bus localizations.
+
+    '''
+    blocks = {}
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for other_hour, (offset, length) in read_index(path).items():
+                f.seek(offset)
+                blocks[other_hour] = f.read(length)
+    blocks[hour] = encode_hour(localizations)
+    write_blocks(path, blocks)
+
+def convert_day(data_dir: str, path: str) -> List[int]:
+    '''
+    Convert the buses-{hour}.json files from the directory to a single archive.
+
+    Returns the hours found in the directory.
+
+    :param data_dir: Directory with buses-{hour}.json files.
+
+    :param path: Path to the archive.
+
+    '''
+    blocks = {}
+    for hour in range(24):
+        hour_path = os.path.join(data_dir, f'buses-{hour}.json')
+        if os.path.exists(hour_path):
+            with open(hour_path, 'r', encoding='utf-8') as f:
+                blocks[hour] = encode_hour(pd.DataFrame(json.load(f)))
+    write_blocks(path, blocks)
+    return sorted(blocks)
+
+if __name__ == "__main__":
+    convert_day('../data', '../data/buses.wba')
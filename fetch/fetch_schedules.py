@@ -1,7 +1,14 @@
-''' Fetches bus stops, lines and schedules from Warsaw Data API and saves them to a csv file. '''
+''' Fetches bus stops, lines and schedules from Warsaw Data API and saves them to a csv file.
+
+Bus stops are kept as versioned snapshots with the diff to the previous one,
+so the schedule is crawled again only for the stops which changed.
+'''
+import asyncio
+import hashlib
 import json
 import os
-from typing import List, Dict
+from datetime import datetime
+from typing import List, Dict, Optional
 import requests
 import pandas as pd
 from tqdm import tqdm
@@ -12,17 +19,21 @@ URL2 = 'https://api.um.warszawa.pl/api/action/dbstore_get'
 
 PATH_TO_SCHEDULE = '../data/schedule.csv'
 PATH_TO_BUS_STOPS = '../data/bus_stops.json'
+SNAPSHOTS_DIR = '../data/bus_stops_snapshots'
+CONCURRENCY = 8
 
-def get_bus_stops() -> List[Dict[str, str]]:
+def get_bus_stops(url: str = URL2) -> List[Dict[str, str]]:
     '''
     Get all bus stops from Warsaw Data API.
+
+    :param url: URL of the dbstore_get endpoint.
     
     '''
     params = {
         'id': 'ab75c33d-3a26-4342-b36a-6e5fef0a3ac3',
         'apikey': API_KEY,
     }
-    response = requests.get(URL2, params=params, timeout=10)
+    response = requests.get(url, params=params, timeout=10)
     data = response.json()
     data = data['result']
 
@@ -37,7 +48,7 @@ def get_bus_stops() -> List[Dict[str, str]]:
                        'Direction': bus_stop[6]['value']})
     return result
 
-def get_lines(busstop_id: str, busstop_nr: str) -> List[str]:
+def get_lines(busstop_id: str, busstop_nr: str, url: str = URL1) -> List[str]:
     '''
     Get all lines from given bus stop.
     
@@ -45,6 +56,8 @@ def get_lines(busstop_id: str, busstop_nr: str) -> List[str]:
 
     :param busstop_nr: Number of the bus stop.
 
+    :param url: URL of the dbtimetable_get endpoint.
+
     '''
     params = {
         'id': '88cd555f-6f31-43ca-9de4-66c479ad5942',
@@ -53,7 +66,7 @@ def get_lines(busstop_id: str, busstop_nr: str) -> List[str]:
         'busstopNr': busstop_nr,
     }
 
-    response = requests.get(URL1, params=params, timeout=10)
+    response = requests.get(url, params=params, timeout=10)
 
     data = response.json()
     data = data['result']
@@ -64,7 +77,8 @@ def get_lines(busstop_id: str, busstop_nr: str) -> List[str]:
         result.append(line[0]['value'])
     return result
 
-def get_schedule(line: str, busstop_id: str, busstop_nr: str) -> List[Dict[str, str]]:
+def get_schedule(line: str, busstop_id: str, busstop_nr: str,
+                 url: str = URL1) -> List[Dict[str, str]]:
     '''
     Get schedule for given line and bus stop.
     
@@ -74,6 +88,8 @@ def get_schedule(line: str, busstop_id: str, busstop_nr: str) -> List[Dict[str,
 
     :param busstop_nr: Number of the bus stop.
 
+    :param url: URL of the dbtimetable_get endpoint.
+
     '''
     params = {
         'id': 'e923fa0e-d96c-43f9-ae6e-60518c9f3238',
@@ -83,7 +99,7 @@ def get_schedule(line: str, busstop_id: str, busstop_nr: str) -> List[Dict[str,
         'line': line,
     }
 
-    response = requests.get(URL1, params=params, timeout=10)
+    response = requests.get(url, params=params, timeout=10)
 
     data = response.json()
 
@@ -98,13 +114,336 @@ def get_schedule(line: str, busstop_id: str, busstop_nr: str) -> List[Dict[str,
                        'Time': event[5]['value']})
     return result
 
+def stop_key(bus_stop: Dict[str, str]) -> str:
+    '''
+    Get the key identifying the bus stop.
+
+    :param bus_stop: Bus stop as returned by get_bus_stops.
+
+    '''
+    return f'{bus_stop["BusstopID"]}/{bus_stop["BusstopNr"]}'
+
+def stop_hash(bus_stop: Dict[str, str]) -> str:
+    '''
+    Get the hash of the bus stop content.
+
+    :param bus_stop: Bus stop as returned by get_bus_stops.
+
+    '''
+    content = json.dumps(bus_stop, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def diff_bus_stops(old: List[Dict[str, str]],
+                   new: List[Dict[str, str]]) -> Dict[str, List[Dict[str, str]]]:
+    '''
+    Compare two lists of bus stops.
+
+    Returns the added, removed, moved (with changed coordinates) and otherwise changed stops.
+
+    :param old: Previous bus stops.
+
+    :param new: Current bus stops.
+
+    '''
+    old_stops = {stop_key(bus_stop): bus_stop for bus_stop in old}
+    new_stops = {stop_key(bus_stop): bus_stop for bus_stop in new}
+    diff: Dict[str, List[Dict[str, str]]] = {'added': [], 'removed': [], 'moved': [],
+                                             'changed': []}
+    for key, bus_stop in new_stops.items():
+        if key not in old_stops:
+            diff['added'].append(bus_stop)
+        elif stop_hash(bus_stop) != stop_hash(old_stops[key]):
+            old_stop = old_stops[key]
+            if (bus_stop['Latitude'], bus_stop['Longitude']) \
+               != (old_stop['Latitude'], old_stop['Longitude']):
+                diff['moved'].append(bus_stop)
+            else:
+                diff['changed'].append(bus_stop)
+    diff['removed'] = [bus_stop for key, bus_stop in old_stops.items() if key not in new_stops]
+    return diff
+
+def latest_version(snapshots_dir: str) -> Optional[int]:
+    '''
+    Get the version of the latest snapshot, None if there are no snapshots.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    '''
+    if not os.path.exists(snapshots_dir):
+        return None
+    versions = [int(name[len('snapshot-'):-len('.json')]) for name in os.listdir(snapshots_dir)
+                if name.startswith('snapshot-') and name.endswith('.json')]
+    return max(versions, default=None)
+
+def save_snapshot(bus_stops: List[Dict[str, str]], diff: Dict, version: int,
+                  snapshots_dir: str = SNAPSHOTS_DIR):
+    '''
+    Save the bus stops as the snapshot of the given version, with its diff to the previous one.
+
+    :param bus_stops: Bus stops as returned by get_bus_stops.
+
+    :param diff: Diff to the previous snapshot, as returned by diff_bus_stops.
+
+    :param version: Version of the snapshot.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    '''
+    if not os.path.exists(snapshots_dir):
+        os.makedirs(snapshots_dir)
+    snapshot = {
+        'version': version,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'hashes': {stop_key(bus_stop): stop_hash(bus_stop) for bus_stop in bus_stops},
+        'stops': bus_stops,
+    }
+    with open(os.path.join(snapshots_dir, f'diff-{version}.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(diff, f)
+    with open(os.path.join(snapshots_dir, f'snapshot-{version}.json'), 'w',
+              encoding='utf-8') as f:
+        json.dump(snapshot, f)
+
+def refresh_bus_stops(path_to_bus_stops: str = PATH_TO_BUS_STOPS,
+                      snapshots_dir: str = SNAPSHOTS_DIR,
+                      url: str = URL2) -> Dict:
+    '''
+    Download the bus stops and save them as a new snapshot if they changed.
+
+    The snapshot holds the stops with the hash of each one and is saved together
+    with its diff to the previous snapshot. The bus stops file is rewritten only
+    when the stops changed, so the files depending on it are rebuilt only then.
+
+    Returns the diff with the version of the latest snapshot.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    :param url: URL of the dbstore_get endpoint.
+
+    '''
+    bus_stops = get_bus_stops(url)
+    version = latest_version(snapshots_dir)
+    old: List[Dict[str, str]] = []
+    if version is not None:
+        with open(os.path.join(snapshots_dir, f'snapshot-{version}.json'), 'r',
+                  encoding='utf-8') as f:
+            old = json.load(f)['stops']
+
+    diff = diff_bus_stops(old, bus_stops)
+    changed = any(diff.values()) or version is None
+    if changed:
+        version = 1 if version is None else version + 1
+        save_snapshot(bus_stops, diff, version, snapshots_dir)
+    if changed or not os.path.exists(path_to_bus_stops):
+        with open(path_to_bus_stops, 'w', encoding='utf-8') as f:
+            json.dump(bus_stops, f)
+
+    diff['version'] = version
+    return diff
+
+async def crawl_bus_stops(bus_stops: List[Dict[str, str]], url: str = URL1,
+                          concurrency: int = CONCURRENCY) -> List[Dict[str, str]]:
+    '''
+    Get the schedules of all lines at the given bus stops, querying several stops at once.
+
+    :param bus_stops: Bus stops to crawl.
+
+    :param url: URL of the dbtimetable_get endpoint.
+
+    :param concurrency: Maximum number of bus stops crawled at the same time.
+
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def crawl(bus_stop: Dict[str, str]) -> List[Dict[str, str]]:
+        async with semaphore:
+            busstop_id, busstop_nr = bus_stop['BusstopID'], bus_stop['BusstopNr']
+            lines = await asyncio.to_thread(get_lines, busstop_id, busstop_nr, url)
+            result = []
+            for line in lines:
+                result += await asyncio.to_thread(get_schedule, line, busstop_id,
+                                                  busstop_nr, url)
+            return result
+
+    schedules = await asyncio.gather(*(crawl(bus_stop) for bus_stop in bus_stops))
+    return [event for schedule in schedules for event in schedule]
+
+async def update_schedule(diff: Dict, path_to_schedule: str = PATH_TO_SCHEDULE,
+                          url: str = URL1, concurrency: int = CONCURRENCY) -> int:
+    '''
+    Update the schedule for the bus stops from the diff.
+
+    Rows of removed stops are dropped and added or changed stops are crawled again.
+    Stops that only moved keep their rows. Returns the number of crawled rows.
+
+    :param diff: Diff returned by refresh_bus_stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param url: URL of the dbtimetable_get endpoint.
+
+    :param concurrency: Maximum number of bus stops crawled at the same time.
+
+    '''
+    affected = diff['removed'] + diff['added'] + diff['changed']
+    if not affected:
+        return 0
+    crawled = await crawl_bus_stops(diff['added'] + diff['changed'], url, concurrency)
+
+    schedule = pd.DataFrame()
+    if os.path.exists(path_to_schedule):
+        schedule = pd.read_csv(path_to_schedule, dtype=str, index_col=0)
+    if not schedule.empty:
+        keys = schedule['BusstopID'] + '/' + schedule['BusstopNr']
+        schedule = schedule[~keys.isin([stop_key(bus_stop) for bus_stop in affected])]
+    schedule = pd.concat([schedule, pd.DataFrame(crawled)], ignore_index=True)
+    schedule.to_csv(path_to_schedule)
+    return len(crawled)
+
+def applied_version(snapshots_dir: str) -> int:
+    '''
+    Get the version of the last snapshot whose diff was applied to the schedule, 0 if none was.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    '''
+    try:
+        with open(os.path.join(snapshots_dir, 'schedule.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)['version']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+def mark_applied(snapshots_dir: str, version: int, crawled: bool = False):
+    '''
+    Record that the schedule is up to date with the snapshot of the given version.
+
+    The time of the last crawl of all the bus stops is recorded too,
+    diffs applied since then only update the schedule of some stops.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    :param version: Version of the snapshot.
+
+    :param crawled: If True, the whole schedule was just crawled (or taken as it is).
+
+    '''
+    if not os.path.exists(snapshots_dir):
+        os.makedirs(snapshots_dir)
+    path = os.path.join(snapshots_dir, 'schedule.json')
+    state = {'version': version, 'crawled': None}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state['crawled'] = json.load(f).get('crawled')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if crawled:
+        state['crawled'] = datetime.now().isoformat(timespec='seconds')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def seed_snapshots(path_to_bus_stops: str = PATH_TO_BUS_STOPS,
+                   snapshots_dir: str = SNAPSHOTS_DIR,
+                   url: str = URL2) -> bool:
+    '''
+    Take the bus stops of a schedule crawled without snapshots as the first snapshot.
+
+    The snapshot is marked as applied, so only the stops which changed since
+    the schedule was crawled are crawled again, not the whole city.
+    The stops are read from the bus stops file or downloaded if there is none.
+    Returns True if the snapshot was seeded, False if there already are snapshots.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    :param url: URL of the dbstore_get endpoint.
+
+    '''
+    if latest_version(snapshots_dir) is not None:
+        return False
+    if os.path.exists(path_to_bus_stops):
+        with open(path_to_bus_stops, 'r', encoding='utf-8') as f:
+            bus_stops = json.load(f)
+    else:
+        bus_stops = get_bus_stops(url)
+        with open(path_to_bus_stops, 'w', encoding='utf-8') as f:
+            json.dump(bus_stops, f)
+    save_snapshot(bus_stops, diff_bus_stops([], bus_stops), 1, snapshots_dir)
+    mark_applied(snapshots_dir, 1, crawled=True)
+    return True
+
+async def apply_diffs(path_to_schedule: str = PATH_TO_SCHEDULE,
+                      snapshots_dir: str = SNAPSHOTS_DIR,
+                      url: str = URL1,
+                      concurrency: int = CONCURRENCY) -> List[int]:
+    '''
+    Update the schedule with the diffs of all the snapshots not applied to it yet.
+
+    Each diff is recorded as applied only after the schedule is saved,
+    so diffs whose crawl failed are applied again by the next call.
+    Returns the versions of the applied diffs.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    :param url: URL of the dbtimetable_get endpoint.
+
+    :param concurrency: Maximum number of bus stops crawled at the same time.
+
+    '''
+    versions = list(range(applied_version(snapshots_dir) + 1,
+                          (latest_version(snapshots_dir) or 0) + 1))
+    for version in versions:
+        with open(os.path.join(snapshots_dir, f'diff-{version}.json'), 'r',
+                  encoding='utf-8') as f:
+            diff = json.load(f)
+        await update_schedule(diff, path_to_schedule, url, concurrency)
+        mark_applied(snapshots_dir, version)
+    return versions
+
+async def refresh(path_to_bus_stops: str = PATH_TO_BUS_STOPS,
+                  path_to_schedule: str = PATH_TO_SCHEDULE,
+                  snapshots_dir: str = SNAPSHOTS_DIR,
+                  concurrency: int = CONCURRENCY,
+                  stops_url: str = URL2,
+                  timetable_url: str = URL1) -> Dict:
+    '''
+    Refresh the bus stops and update the schedule of the changed ones.
+
+    A schedule crawled before there were snapshots is taken as up to date
+    with its bus stops, see seed_snapshots. Returns the diff of the bus stops.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param snapshots_dir: Directory with the snapshots.
+
+    :param concurrency: Maximum number of bus stops crawled at the same time.
+
+    :param stops_url: URL of the dbstore_get endpoint.
+
+    :param timetable_url: URL of the dbtimetable_get endpoint.
+
+    '''
+    if os.path.exists(path_to_schedule):
+        await asyncio.to_thread(seed_snapshots, path_to_bus_stops, snapshots_dir, stops_url)
+    diff = await asyncio.to_thread(refresh_bus_stops, path_to_bus_stops, snapshots_dir,
+                                   stops_url)
+    await apply_diffs(path_to_schedule, snapshots_dir, timetable_url, concurrency)
+    return diff
+
 def save_bus_stops():
     '''
-    Save bus stops to a file.
+    Save bus stops to a file, if they changed since the last snapshot.
     
     '''
-    with open(PATH_TO_BUS_STOPS, 'w', encoding='utf-8') as f:
-        json.dump(get_bus_stops(), f)
+    refresh_bus_stops()
 
 def save_schedule():
     '''
@@ -121,7 +460,17 @@ def save_schedule():
             result = result + get_schedule(line, bus_stop['BusstopID'], bus_stop['BusstopNr'])
     df = pd.DataFrame(result)
     df.to_csv(PATH_TO_SCHEDULE)
+    # the whole schedule is up to date with the bus stops
+    version = latest_version(SNAPSHOTS_DIR)
+    if version is not None:
+        mark_applied(SNAPSHOTS_DIR, version, crawled=True)
 
 if __name__ == "__main__":
-    save_bus_stops()
-    save_schedule()
+    if os.path.exists(PATH_TO_SCHEDULE):
+        changes = asyncio.run(refresh())
+        print(f'Bus stops version {changes["version"]}: '
+              + ', '.join(f'{len(changes[kind])} {kind}'
+                          for kind in ['added', 'removed', 'moved', 'changed']))
+    else:
+        save_bus_stops()
+        save_schedule()
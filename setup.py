@@ -11,6 +11,7 @@ setup(
         'geopy',
         'matplotlib',
         'folium',
+        'pyarrow',
     ],
     description='A package for fetching data from the Warsaw API.'
 )
\ No newline at end of file
@@ -1,8 +1,20 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 from fetch.fetch_schedules import get_bus_stops, get_lines, get_schedule
+from fetch.fetch_schedules import applied_version, diff_bus_stops, refresh
 from fetch.fetch_day import get_current_localization
+from fetch.archive import add_hour, convert_day, read_hour, read_index
 import pandas as pd
 
+PATH_TO_LOCALIZATIONS = 'tests/test_data/test-buses.json'
+
 TEST_REQUESTS = False
 
 class TestSchedulesFetch(unittest.TestCase):
@@ -54,5 +66,191 @@ class TestDayFetch(unittest.TestCase):
             for bus in localization:
                 self.assertTrue(bus['Lines'].isdigit() or bus['Lines'][0] in ['N', 'E', 'L', 'Z'])
 
+class TestArchive(unittest.TestCase):
+    ''' Test archive.py module. '''
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        shutil.copy(PATH_TO_LOCALIZATIONS, os.path.join(self.data_dir, 'buses-9.json'))
+        self.path = os.path.join(self.data_dir, 'buses.wba')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_convert_day(self):
+        ''' Test convert_day and read_hour functions. '''
+        self.assertEqual(convert_day(self.data_dir, self.path), [9])
+        original = pd.read_json(PATH_TO_LOCALIZATIONS, dtype=False, convert_dates=False)
+        archived = read_hour(self.path, 9)
+        self.assertEqual(sorted(archived.columns), sorted(original.columns))
+
+        key = ['VehicleNumber', 'Lines', 'Time']
+        original = original.sort_values(key, ignore_index=True)
+        archived = archived.sort_values(key, ignore_index=True)
+        for column in key + ['Brigade']:
+            self.assertEqual(archived[column].tolist(), original[column].astype(str).tolist())
+        self.assertTrue(((archived['Lat'] - original['Lat']).abs() < 1e-6).all())
+        self.assertTrue(((archived['Lon'] - original['Lon']).abs() < 1e-6).all())
+
+    def test_add_hour(self):
+        ''' Test add_hour function. '''
+        convert_day(self.data_dir, self.path)
+        localizations = read_hour(self.path, 9)
+        repeated = pd.concat([localizations, localizations])
+        add_hour(self.path, 10, repeated)
+        self.assertEqual(sorted(read_index(self.path)), [9, 10])
+        self.assertEqual(len(read_hour(self.path, 10)), len(localizations))
+        self.assertEqual(len(read_hour(self.path, 9)), len(localizations))
+
+STUB_BUS_STOPS = [
+    ['7009', '01', 'Saska', '1', '52.2401', '21.0501', 'Gocław', '2023-01-01'],
+    ['7009', '02', 'Saska', '1', '52.2402', '21.0502', 'Centrum', '2023-01-01'],
+    ['7010', '01', 'Rondo', '1', '52.2501', '21.0601', 'Wola', '2023-01-01'],
+]
+STUB_LINES = {'7009': ['123'], '7010': ['123', '145']}
+
+class StubHandler(BaseHTTPRequestHandler):
+    ''' Stub of the Warsaw Data API endpoints. '''
+    # if True, the timetable endpoint fails
+    failing = False
+
+    def do_GET(self):
+        ''' Answer the request in the format of the API. '''
+        query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        if query['id'] == 'ab75c33d-3a26-4342-b36a-6e5fef0a3ac3':
+            rows = STUB_BUS_STOPS
+        elif StubHandler.failing:
+            self.send_error(500)
+            return
+        elif query['id'] == '88cd555f-6f31-43ca-9de4-66c479ad5942':
+            rows = [[line] for line in STUB_LINES[query['busstopId']]]
+        else:
+            rows = [['', '', '1', 'Gocław', '', '08:00:00'],
+                    ['', '', '2', 'Gocław', '', '08:10:00']]
+        body = json.dumps({'result': [{'values': [{'value': value} for value in row]}
+                                      for row in rows]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+class TestBusStopSnapshots(unittest.TestCase):
+    ''' Test the bus stop snapshots of fetch_schedules.py module. '''
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.path_to_bus_stops = os.path.join(self.data_dir, 'bus_stops.json')
+        self.path_to_schedule = os.path.join(self.data_dir, 'schedule.csv')
+        self.snapshots_dir = os.path.join(self.data_dir, 'snapshots')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+        self.bus_stops = [row.copy() for row in STUB_BUS_STOPS]
+
+    def tearDown(self):
+        STUB_BUS_STOPS[:] = self.bus_stops
+        STUB_LINES.pop('7011', None)
+        StubHandler.failing = False
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def refresh(self):
+        ''' Refresh the bus stops from the stub. '''
+        return asyncio.run(refresh(self.path_to_bus_stops, self.path_to_schedule,
+                                   self.snapshots_dir, stops_url=self.url,
+                                   timetable_url=self.url))
+
+    def test_diff_bus_stops(self):
+        ''' Test diff_bus_stops function. '''
+        old = [{'BusstopID': '1', 'BusstopNr': '01', 'Latitude': '52.1', 'Longitude': '21.1',
+                'BusstopName': 'A'},
+               {'BusstopID': '2', 'BusstopNr': '01', 'Latitude': '52.2', 'Longitude': '21.2',
+                'BusstopName': 'B'},
+               {'BusstopID': '3', 'BusstopNr': '01', 'Latitude': '52.3', 'Longitude': '21.3',
+                'BusstopName': 'C'}]
+        new = [dict(old[0], Latitude='52.15'), dict(old[1], BusstopName='BB'),
+               {'BusstopID': '4', 'BusstopNr': '01', 'Latitude': '52.4', 'Longitude': '21.4',
+                'BusstopName': 'D'}]
+        diff = diff_bus_stops(old, new)
+        self.assertEqual([bus_stop['BusstopID'] for bus_stop in diff['moved']], ['1'])
+        self.assertEqual([bus_stop['BusstopID'] for bus_stop in diff['changed']], ['2'])
+        self.assertEqual([bus_stop['BusstopID'] for bus_stop in diff['removed']], ['3'])
+        self.assertEqual([bus_stop['BusstopID'] for bus_stop in diff['added']], ['4'])
+
+    def test_refresh_bus_stops(self):
+        ''' Test refresh_bus_stops and update_schedule functions. '''
+        diff = self.refresh()
+        self.assertEqual(diff['version'], 1)
+        self.assertEqual(len(diff['added']), 3)
+        schedule = pd.read_csv(self.path_to_schedule, dtype=str, index_col=0)
+        self.assertEqual(len(schedule), 8)
+
+        mtime = os.stat(self.path_to_bus_stops).st_mtime_ns
+        diff = self.refresh()
+        self.assertEqual(diff['version'], 1)
+        self.assertFalse(any(diff[kind] for kind in ['added', 'removed', 'moved', 'changed']))
+        self.assertEqual(os.stat(self.path_to_bus_stops).st_mtime_ns, mtime)
+
+        STUB_BUS_STOPS[0][4] = '52.2411'
+        del STUB_BUS_STOPS[2]
+        diff = self.refresh()
+        self.assertEqual(diff['version'], 2)
+        self.assertEqual([bus_stop['BusstopNr'] for bus_stop in diff['moved']], ['01'])
+        self.assertEqual([bus_stop['BusstopID'] for bus_stop in diff['removed']], ['7010'])
+        self.assertFalse(diff['added'] or diff['changed'])
+        schedule = pd.read_csv(self.path_to_schedule, dtype=str, index_col=0)
+        self.assertEqual(sorted(schedule['BusstopID'].unique()), ['7009'])
+        self.assertEqual(len(schedule), 4)
+        with open(self.path_to_bus_stops, 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f)[0]['Latitude'], '52.2411')
+        self.assertTrue(os.path.exists(os.path.join(self.snapshots_dir, 'diff-2.json')))
+
+    def test_failed_crawl(self):
+        ''' Test that diffs not applied because of a failed crawl are applied later. '''
+        self.refresh()
+        STUB_BUS_STOPS.append(['7011', '01', 'Plac', '1', '52.2601', '21.0701', 'Wola',
+                               '2023-01-01'])
+        STUB_LINES['7011'] = ['145']
+        StubHandler.failing = True
+        with self.assertRaises(ValueError):
+            self.refresh()
+        self.assertEqual(applied_version(self.snapshots_dir), 1)
+
+        StubHandler.failing = False
+        diff = self.refresh()
+        self.assertFalse(diff['added'])
+        self.assertEqual(applied_version(self.snapshots_dir), 2)
+        schedule = pd.read_csv(self.path_to_schedule, dtype=str, index_col=0)
+        self.assertEqual(len(schedule[schedule['BusstopID'] == '7011']), 2)
+
+    def test_seed_snapshots(self):
+        ''' Test that a schedule crawled before the snapshots is not crawled again. '''
+        with open(self.path_to_bus_stops, 'w', encoding='utf-8') as f:
+            json.dump(get_bus_stops(self.url), f)
+        pd.DataFrame([{'Line': '123', 'BusstopID': row[0], 'BusstopNr': row[1], 'Brigade': '9',
+                       'Direction': 'Gocław', 'Time': '06:00:00'} for row in STUB_BUS_STOPS]
+                     ).to_csv(self.path_to_schedule)
+        STUB_BUS_STOPS[2][2] = 'Rondo Daszyńskiego'
+        diff = self.refresh()
+        self.assertEqual(diff['version'], 2)
+        self.assertEqual([bus_stop['BusstopID'] for bus_stop in diff['changed']], ['7010'])
+        self.assertEqual(applied_version(self.snapshots_dir), 2)
+        schedule = pd.read_csv(self.path_to_schedule, dtype=str, index_col=0)
+        self.assertEqual(schedule[schedule['BusstopID'] == '7009']['Time'].tolist(),
+                         ['06:00:00'] * 2)
+        self.assertEqual(len(schedule[schedule['BusstopID'] == '7010']), 4)
+
+        os.remove(self.path_to_bus_stops)
+        shutil.rmtree(self.snapshots_dir)
+        diff = self.refresh()
+        self.assertEqual(diff['version'], 1)
+        self.assertFalse(diff['added'])
+        self.assertEqual(applied_version(self.snapshots_dir), 1)
+        self.assertEqual(len(pd.read_csv(self.path_to_schedule, dtype=str, index_col=0)), 6)
+
 if __name__ == '__main__':
     unittest.main()
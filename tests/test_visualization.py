@@ -1,16 +1,43 @@
 import unittest
 import datetime
+import json
+import os
+import shutil
+import tempfile
 from visualization.overspeed import calculate_speed, count_overspeeding_vehicles
 from visualization.overspeed import Street
 from visualization.punctuality import get_line_schedule, get_line_bus_stops, get_line_stops, \
-                                      get_stop_schedule, get_delays
+                                      get_stop_schedule, get_delays, get_delays_in_parallel
 from visualization.utils import calculate_distance, date_to_seconds, get_address_components, \
-                                get_current_localization
+                                get_current_localization, calculate_distances
+from visualization.arrivals import build_events, get_delays_from_events, get_headways, \
+                                   get_stops_of_lines, update_events
+from visualization.cleaning import clean_localizations
+from visualization.compact_schedule import CompactSchedule, load_schedule
+from visualization.cube import AnalysisCube, histogram_quantile
+from visualization.line_stops import LineStops, affected_stops, load_line_stops, snapshots_state
+from visualization.sampling import estimate_delays, sample_vehicles, stratified_total
+from visualization.shared_tables import attach_table, publish_schedule_tables, publish_table, \
+                                        table_rows
+from visualization.cache import cached_call, evict, file_digest, load, load_derived, make_key, \
+                                store
 import pandas as pd
 
 PATH_TO_LOCALIZATIONS = 'tests/test_data/test-buses.json'
-PATH_TO_BUS_STOPS = 'tests/test_data/test-bus-stops.json'
-PATH_TO_SCHEDULE = 'tests/test_data/test-schedule.csv'
+# files derived from the bus stops and the schedule are saved next to them,
+# so the tests use copies instead of the files in test_data
+DATA_DIR = tempfile.mkdtemp()
+PATH_TO_BUS_STOPS = os.path.join(DATA_DIR, 'test-bus-stops.json')
+PATH_TO_SCHEDULE = os.path.join(DATA_DIR, 'test-schedule.csv')
+
+def setUpModule():
+    ''' Copy the bus stops and the schedule to DATA_DIR. '''
+    shutil.copy('tests/test_data/test-bus-stops.json', PATH_TO_BUS_STOPS)
+    shutil.copy('tests/test_data/test-schedule.csv', PATH_TO_SCHEDULE)
+
+def tearDownModule():
+    ''' Remove DATA_DIR with the files derived from the copies. '''
+    shutil.rmtree(DATA_DIR)
 
 TEST_REQUESTS = False
 
@@ -28,6 +55,17 @@ class TestUtils(unittest.TestCase):
             (52.21244498628319, 20.982054528763946))
         self.assertEqual(distance, 0)
 
+    def test_calculate_distances(self):
+        ''' Test calculate_distances function. '''
+        distances = calculate_distances([52.21244498628319, 52.21244498628319],
+                                        [20.982054528763946, 20.982054528763946],
+                                        [52.21121798800691, 52.21244498628319],
+                                        [20.982040191304982, 20.982054528763946])
+        expected = calculate_distance((52.21244498628319, 20.982054528763946),
+                                      (52.21121798800691, 20.982040191304982))
+        self.assertAlmostEqual(distances[0], expected, places=3)
+        self.assertEqual(distances[1], 0)
+
     def test_date_to_seconds(self):
         ''' Test date_to_seconds function. '''
         seconds = date_to_seconds('1970-01-01 01:00:00')
@@ -94,6 +132,18 @@ class TestOverspeed(unittest.TestCase):
             self.assertEqual(list(result.keys()), [Street('Kolonia Lubeckiego',  'Ochota', 'Warszawa')])
             self.assertEqual(len(result[Street('Kolonia Lubeckiego',  'Ochota', 'Warszawa')]), 1)
 
+    def test_overspeeding_report(self):
+        ''' Test returning the numbers of samples removed by the cleaning. '''
+        sample = {'Lines': '182', 'Lat': 52.2159, 'Lon': 20.9826,
+                  'Time': '2024-02-16 09:15:40', 'Brigade': '1', 'VehicleNumber': '8'}
+        path = os.path.join(DATA_DIR, 'report-buses.json')
+        pd.DataFrame([sample, sample, dict(sample, Time='2024-02-16 09:16:40')]) \
+          .to_json(path, orient='records')
+        self.assertEqual(count_overspeeding_vehicles(path, False), (0, {}))
+        count, result, report = count_overspeeding_vehicles(path, False, with_report=True)
+        self.assertEqual((count, result), (0, {}))
+        self.assertEqual(report, {'duplicate_reports': 1, 'stale': 0, 'jumps': 0})
+
 class TestPunctuality(unittest.TestCase):
     ''' Test punctuality.py module. '''
 
@@ -116,6 +166,10 @@ class TestPunctuality(unittest.TestCase):
         self.assertEqual(bus_stops['Latitude'].values[0], 52.21599054475676)
         self.assertEqual(bus_stops['Longitude'].values[0], 20.982646082482425)
 
+        bus_stops['LatRound'] = 0.0
+        self.assertEqual(get_line_bus_stops('182', PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+                         ['LatRound'].values[0], 52.216)
+
     def get_line_stops(self):
         ''' Test get_line_stops function. '''
         localizations = pd.read_json(PATH_TO_LOCALIZATIONS)
@@ -164,3 +218,592 @@ class TestPunctuality(unittest.TestCase):
         self.assertEqual(delays['Time'].values[0], datetime.time(9, 15, 40))
         self.assertEqual(delays['ScheduledTime'].values[0], datetime.time(9, 10, 0))
         self.assertEqual(int(delays['Delay'].values[0]), 5)
+
+class TestCache(unittest.TestCase):
+    ''' Test cache.py module. '''
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_make_key(self):
+        ''' Test make_key function. '''
+        key = make_key('delays', [PATH_TO_SCHEDULE], {'max_delay': 30})
+        self.assertEqual(key, make_key('delays', [PATH_TO_SCHEDULE], {'max_delay': 30}))
+        self.assertNotEqual(key, make_key('delays', [PATH_TO_SCHEDULE], {'max_delay': 20}))
+        self.assertNotEqual(key, make_key('delays', [PATH_TO_BUS_STOPS], {'max_delay': 30}))
+        self.assertNotEqual(key, make_key('delays', [PATH_TO_SCHEDULE], {'max_delay': 30}, 1))
+
+    def test_cached_call(self):
+        ''' Test cached_call function. '''
+        calls = []
+        def count_rows(path, offset):
+            calls.append(path)
+            return len(pd.read_csv(path)) + offset
+
+        path = os.path.join(self.cache_dir, 'schedule.csv')
+        shutil.copy(PATH_TO_SCHEDULE, path)
+        self.assertEqual(cached_call(count_rows, [path], {'offset': 0}, self.cache_dir), 4)
+        self.assertEqual(cached_call(count_rows, [path], {'offset': 0}, self.cache_dir), 4)
+        self.assertEqual(len(calls), 1)
+
+        self.assertEqual(cached_call(count_rows, [path], {'offset': 1}, self.cache_dir), 5)
+        self.assertEqual(len(calls), 2)
+
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('182,4121,5,10:10:00,1,Pomnik Lotnika\n')
+        self.assertNotEqual(file_digest(path), file_digest(PATH_TO_SCHEDULE))
+        self.assertEqual(cached_call(count_rows, [path], {'offset': 0}, self.cache_dir), 5)
+        self.assertEqual(len(calls), 3)
+
+    def test_load_derived(self):
+        ''' Test load_derived function. '''
+        calls = []
+        def count_rows():
+            calls.append(path)
+            return len(pd.read_csv(path))
+
+        path = os.path.join(self.cache_dir, 'schedule.csv')
+        derived_path = os.path.join(self.cache_dir, 'schedule.rows.pkl')
+        shutil.copy(PATH_TO_SCHEDULE, path)
+        self.assertEqual(load_derived(derived_path, [path], count_rows), 4)
+        self.assertEqual(load_derived(derived_path, [path], count_rows), 4)
+        self.assertEqual(len(calls), 1)
+
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('182,4121,5,10:10:00,1,Pomnik Lotnika\n')
+        self.assertEqual(load_derived(derived_path, [path], count_rows), 5)
+        self.assertEqual(len(calls), 2)
+
+    def test_stale_pickles(self):
+        ''' Test that results which cannot be unpickled are recomputed. '''
+        path = os.path.join(self.cache_dir, 'schedule.csv')
+        derived_path = os.path.join(self.cache_dir, 'schedule.rows.pkl')
+        shutil.copy(PATH_TO_SCHEDULE, path)
+        # a pickle of a class from a module which does not exist anymore
+        stale = b'\x80\x04\x95\x1b\x00\x00\x00\x00\x00\x00\x00\x8c\x0cmoved_module\x94\x8c' \
+                b'\x06Street\x94\x93\x94.'
+        key = make_key('count_rows', [path], {})
+        with open(os.path.join(self.cache_dir, f'{key}.pkl'), 'wb') as f:
+            f.write(stale)
+        with open(derived_path, 'wb') as f:
+            f.write(stale)
+
+        self.assertEqual(load(key, self.cache_dir), (False, None))
+        self.assertEqual(load_derived(derived_path, [path], lambda: 4), 4)
+        self.assertEqual(load_derived(derived_path, [path], lambda: 5), 4)
+
+    def test_evict(self):
+        ''' Test evict function. '''
+        for i in range(4):
+            store(f'key{i}', 'x' * 1000, self.cache_dir)
+            os.utime(os.path.join(self.cache_dir, f'key{i}.pkl'), ns=(i, i))
+        evict(self.cache_dir, 2500)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['key2.pkl', 'key3.pkl'])
+
+class TestCube(unittest.TestCase):
+    ''' Test cube.py module. '''
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.delays = get_delays(PATH_TO_LOCALIZATIONS, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_histogram_quantile(self):
+        ''' Test histogram_quantile function. '''
+        quantiles = histogram_quantile([[0, 2, 2, 0], [0, 0, 0, 0]], 0.5)
+        self.assertEqual(quantiles[0], 2)
+        self.assertTrue(pd.isna(quantiles[1]))
+
+    def test_rollup_delays(self):
+        ''' Test adding delays and rolling them up. '''
+        path = os.path.join(self.cache_dir, 'cube')
+        cube = AnalysisCube(path)
+        cube.add_delays(self.delays, datetime.date(2024, 2, 16), 9)
+        cube.add_delays(self.delays, datetime.date(2024, 2, 16), 9) # replaces the hour
+        cube.add_delays(self.delays, datetime.date(2024, 2, 17), 9)
+        cube.save()
+
+        cube = AnalysisCube(path)
+        result = cube.rollup_delays(['Line'], since=datetime.date(2024, 2, 17))
+        self.assertEqual(result['Line'].tolist(), ['182', '187', '523', 'N22'])
+        self.assertEqual(result['Count'].tolist(), [1, 1, 1, 1])
+        self.assertAlmostEqual(result['MeanDelay'].values[0], 17 / 3)
+
+        result = cube.rollup_delays([], weekdays=[4], hours=[9])
+        self.assertEqual(result['Count'].values[0], 4)
+        self.assertAlmostEqual(result['MeanDelay'].values[0], 19 / 6)
+        self.assertTrue(cube.rollup_delays(['Line'], hours=[8]).empty)
+
+    def test_add_delays(self):
+        ''' Test that delays are aggregated and only changed days are saved. '''
+        path = os.path.join(self.cache_dir, 'cube')
+        cube = AnalysisCube(path)
+        delays = pd.concat([self.delays, self.delays.assign(Brigade=99)], ignore_index=True)
+        cube.add_delays(pd.concat([delays, delays]), datetime.date(2024, 2, 16), 9)
+        self.assertEqual(len(cube.delays), len(delays))
+        self.assertEqual(cube.delays['Count'].tolist(), [2] * len(delays))
+        self.assertEqual(len(cube.table('line_delays')), len(self.delays))
+        cube.save()
+
+        first = os.path.join(path, 'delays--2024-02-16.parquet')
+        mtime = os.stat(first).st_mtime_ns
+        cube = AnalysisCube(path)
+        cube.add_delays(self.delays, datetime.date(2024, 2, 17), 9)
+        cube.save()
+        self.assertEqual(os.stat(first).st_mtime_ns, mtime)
+        cube.add_delays(self.delays, datetime.date(2024, 2, 16), 10)
+        # stops of whole days are rolled up from the daily cells, the changed day from memory
+        by_stops = cube.rollup_delays(['BusstopID', 'BusstopNr'])
+        self.assertTrue(by_stops.equals(cube.rollup_delays(['BusstopID', 'BusstopNr'],
+                                                           hours=range(24))))
+        cube.save()
+        cube = AnalysisCube(path)
+        self.assertTrue(by_stops.equals(cube.rollup_delays(['BusstopID', 'BusstopNr'])))
+        self.assertEqual(cube.rollup_delays([])['Count'].values[0],
+                         2 * len(delays) + 2 * len(self.delays))
+        result = cube.rollup_delays(['Brigade'], hours=[9])
+        self.assertEqual(result['Brigade'].tolist(), [1, 99])
+        self.assertEqual(result['Count'].tolist(), [12, 8])
+        self.assertEqual(cube.rollup_delays(['Hour'], lines=['182'])['Count'].tolist(), [5, 1])
+
+    def test_rollup_overspeeding(self):
+        ''' Test adding overspeeding vehicles and rolling them up. '''
+        cube = AnalysisCube(os.path.join(self.cache_dir, 'cube'))
+        wawelska = Street('Wawelska', 'Ochota', 'Warszawa')
+        banacha = Street('Banacha', 'Ochota', 'Warszawa')
+        cube.add_overspeeding(3, {wawelska: {'1', '2'}, banacha: {'1'}},
+                              datetime.date(2024, 2, 16), 9)
+        cube.add_overspeeding(2, {banacha: {'3', '4'}}, datetime.date(2024, 2, 16), 10)
+        result = cube.rollup_overspeeding(['Street'])
+        self.assertEqual(result['Street'].tolist(), ['Banacha', 'Wawelska'])
+        self.assertEqual(result['Vehicles'].tolist(), [3, 2])
+        cube.save()
+
+        cube = AnalysisCube(os.path.join(self.cache_dir, 'cube'))
+        # vehicles are counted once per hour, not once per street
+        self.assertEqual(cube.rollup_overspeeding(['Day'])['Vehicles'].tolist(), [5])
+        self.assertEqual(cube.rollup_overspeeding(['Hour'], hours=[9])['Vehicles'].tolist(), [3])
+        self.assertEqual(cube.rollup_overspeeding(['District'])['Vehicles'].tolist(), [5])
+
+class TestCompactSchedule(unittest.TestCase):
+    ''' Test compact_schedule.py module. '''
+
+    def setUp(self):
+        rows = []
+        for brigade in [1, 2]:
+            for start in [8 * 3600, 10 * 3600, 23 * 3600 + 1800]:
+                for offset, stop in zip([0, 90, 240], ['4121', '4122', '4123']):
+                    time = start + brigade * 600 + offset
+                    rows.append({'Line': '182', 'BusstopID': stop, 'BusstopNr': '01',
+                                 'Time': f'{time // 3600:02d}:{time // 60 % 60:02d}:'
+                                         f'{time % 60:02d}',
+                                 'Brigade': brigade, 'Direction': 'Dworzec Centralny'})
+        self.schedule = pd.DataFrame(rows)
+
+    def test_compact_schedule(self):
+        ''' Test compressing and expanding the schedule. '''
+        schedule = CompactSchedule(self.schedule)
+        self.assertEqual(len(schedule.pattern_lines), 1)
+        self.assertEqual(len(schedule.trip_starts), 6)
+        self.assertEqual(len(schedule), len(self.schedule))
+
+        columns = list(self.schedule.columns)
+        expanded = schedule.to_frame().sort_values(columns, ignore_index=True)
+        self.assertTrue(expanded.equals(self.schedule.sort_values(columns, ignore_index=True)))
+        self.assertTrue(schedule.line_schedule('187').empty)
+
+    def test_next_departure(self):
+        ''' Test next_departure function. '''
+        schedule = CompactSchedule(self.schedule)
+        self.assertEqual(schedule.next_departure('182', '4122', '01', 2, '10:00:00'), '10:21:30')
+        self.assertEqual(schedule.next_departure('182', '4123', '01', 1, '23:40:00'), '23:44:00')
+        self.assertEqual(schedule.next_departure('182', '4123', '01', 1, '24:00:00'), None)
+        self.assertEqual(schedule.next_departure('187', '4123', '01', 1, '10:00:00'), None)
+
+    def test_load_schedule(self):
+        ''' Test load_schedule function. '''
+        schedule = load_schedule(PATH_TO_SCHEDULE)
+        self.assertIs(schedule, load_schedule(PATH_TO_SCHEDULE))
+        self.assertEqual(len(schedule), len(pd.read_csv(PATH_TO_SCHEDULE)))
+        self.assertTrue(os.path.exists(os.path.join(DATA_DIR, 'test-schedule.trips.pkl')))
+
+class TestSharedTables(unittest.TestCase):
+    ''' Test shared_tables.py module. '''
+
+    def setUp(self):
+        self.shared_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.shared_dir)
+
+    def test_publish_table(self):
+        ''' Test publish_table and attach_table functions. '''
+        table = pd.DataFrame({'Line': ['182', 'N22', '182'], 'BusstopNr': [1, 2, 3],
+                              'Latitude': [52.1, 52.2, None]})
+        directory = os.path.join(self.shared_dir, 'table')
+        publish_table(table, directory)
+        attached = attach_table(directory)
+        self.assertIs(attached, attach_table(directory))
+        self.assertEqual(attached['Line'].tolist(), ['182', 'N22', '182'])
+        self.assertEqual(attached['BusstopNr'].tolist(), [1, 2, 3])
+        self.assertTrue(attached['Latitude'].isna().values[2])
+        with self.assertRaises(ValueError):
+            attached['BusstopNr'].values[0] = 5
+
+    def test_publish_schedule_tables(self):
+        ''' Test publish_schedule_tables function. '''
+        directories = publish_schedule_tables(PATH_TO_SCHEDULE, PATH_TO_BUS_STOPS,
+                                              self.shared_dir)
+        schedule = attach_table(directories['schedule'])
+        bus_stops = attach_table(directories['bus_stops'])
+        self.assertEqual(len(schedule), 4)
+        self.assertEqual(schedule[schedule['Line'] == '182']['Time'].tolist(), ['09:10:00'])
+        self.assertEqual(bus_stops['BusstopID'].tolist(), [4121])
+
+        mtime = os.stat(os.path.join(directories['schedule'], 'table.json')).st_mtime_ns
+        publish_schedule_tables(PATH_TO_SCHEDULE, PATH_TO_BUS_STOPS, self.shared_dir)
+        self.assertEqual(os.stat(os.path.join(directories['schedule'], 'table.json'))
+                         .st_mtime_ns, mtime)
+
+    def test_table_rows(self):
+        ''' Test getting the rows of a line from the published tables. '''
+        tables = publish_schedule_tables(PATH_TO_SCHEDULE, PATH_TO_BUS_STOPS, self.shared_dir)
+        self.assertTrue(get_line_schedule('182', PATH_TO_SCHEDULE, tables)
+                        .equals(get_line_schedule('182', PATH_TO_SCHEDULE)))
+        shared = get_line_bus_stops('N22', PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE, tables)
+        local = get_line_bus_stops('N22', PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+        self.assertEqual(list(shared.columns), list(local.columns))
+        self.assertEqual(shared['BusstopID'].tolist(), local['BusstopID'].tolist())
+        self.assertEqual(shared['LatRound'].tolist(), local['LatRound'].tolist())
+        self.assertTrue(table_rows(tables['schedule'], '999').empty)
+
+        table = pd.DataFrame({'Line': [None, '2', '1', None, '1'], 'BusstopNr': [1, 2, 3, 4, 5]})
+        directory = os.path.join(self.shared_dir, 'table')
+        publish_table(table, directory, 'Line')
+        self.assertEqual(table_rows(directory, '1')['BusstopNr'].tolist(), [3, 5])
+        self.assertEqual(table_rows(directory, '2')['BusstopNr'].tolist(), [2])
+        self.assertEqual(len(attach_table(directory)), 5)
+
+    def test_get_delays_in_parallel(self):
+        ''' Test finding delays in worker processes attached to the shared tables. '''
+        delays = get_delays_in_parallel([PATH_TO_LOCALIZATIONS] * 2, PATH_TO_BUS_STOPS,
+                                        PATH_TO_SCHEDULE, 2, shared_dir=self.shared_dir)
+        expected = get_delays(PATH_TO_LOCALIZATIONS, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+        self.assertEqual(len(delays), 2)
+        for result in delays:
+            self.assertEqual(result['Line'].tolist(), expected['Line'].tolist())
+            self.assertEqual(result['Delay'].tolist(), expected['Delay'].tolist())
+
+class TestArrivals(unittest.TestCase):
+    ''' Test arrivals.py module. '''
+
+    def setUp(self):
+        self.line_stops = get_stops_of_lines(PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+        self.localizations = pd.read_json(PATH_TO_LOCALIZATIONS, dtype=False,
+                                          convert_dates=False)
+
+    def test_build_events(self):
+        ''' Test build_events function. '''
+        events = build_events(self.localizations, self.line_stops)
+        self.assertEqual(sorted(events['Line']), ['182', '187', '523', 'N22'])
+        events = events.set_index('Line')
+        self.assertEqual(events.loc['523', 'Samples'], 2)
+        self.assertEqual(events.loc['523', 'Arrival'], pd.Timestamp('2024-02-16 09:15:40'))
+        self.assertEqual(events.loc['523', 'Departure'], pd.Timestamp('2024-02-16 09:15:41'))
+        self.assertEqual(events.loc['182', 'Samples'], 1)
+
+        later = self.localizations[self.localizations['Lines'] == '523'].copy()
+        later['Time'] = '2024-02-16 09:45:40'
+        events = build_events(pd.concat([self.localizations, later]), self.line_stops)
+        self.assertEqual((events['Line'] == '523').sum(), 2)
+        headways = get_headways(events)
+        self.assertEqual(headways[headways['Line'] == '523']['Headway'].max(), 30)
+
+    def test_get_delays_from_events(self):
+        ''' Test get_delays_from_events function. '''
+        events = build_events(self.localizations, self.line_stops)
+        delays = get_delays_from_events(events, PATH_TO_SCHEDULE).sort_values('Line')
+        expected = get_delays(PATH_TO_LOCALIZATIONS, PATH_TO_BUS_STOPS,
+                              PATH_TO_SCHEDULE).sort_values('Line')
+        for column in ['Line', 'BusstopID', 'BusstopNr', 'Brigade', 'Time', 'ScheduledTime']:
+            self.assertEqual(delays[column].tolist(), expected[column].tolist())
+        self.assertEqual(delays['Delay'].round(6).tolist(), expected['Delay'].round(6).tolist())
+
+    def test_padded_brigades(self):
+        ''' Test that zero-padded brigades match the brigades of the schedule. '''
+        localizations = self.localizations.assign(Brigade='01')
+        events = build_events(localizations, self.line_stops)
+        delays = get_delays_from_events(events, PATH_TO_SCHEDULE)
+        self.assertEqual(len(delays), 4)
+        self.assertEqual(delays['Brigade'].tolist(), [1] * 4)
+
+    def test_delays_of_many_visits(self):
+        ''' Test that delays from events match get_delays for several lines and brigades. '''
+        data_dir = tempfile.mkdtemp()
+        try:
+            bus_stops, schedule, localizations = [], [], []
+            for i, line in enumerate(['105', '182', 'N22']):
+                for stop in range(6):
+                    bus_stops.append({'BusstopID': 5000 + 10 * i + stop, 'BusstopNr': 1,
+                                      'Latitude': 52.2 + 0.01 * i, 'Longitude': 21 + 0.01 * stop})
+                for brigade in range(1, 4):
+                    for start in range(7 * 3600 + brigade * 400, 11 * 3600, 1500):
+                        for stop in range(6):
+                            time = start + stop * 180
+                            schedule.append({'Line': line, 'BusstopID': 5000 + 10 * i + stop,
+                                             'BusstopNr': 1, 'Brigade': brigade,
+                                             'Direction': 'Centrum',
+                                             'Time': f'{time // 3600:02d}:'
+                                                     f'{time // 60 % 60:02d}:{time % 60:02d}'})
+                            if not 9 * 3600 <= time < 10 * 3600 - 700:
+                                continue
+                            # samples at the stop and one between the stops
+                            delay = (i * 131 + brigade * 67 + time) % 600
+                            for offset, lat in [(0, 0), (30, 0), (150, 0.003)]:
+                                seconds = time + delay + offset
+                                localizations.append({
+                                    'Lines': line, 'Brigade': str(brigade),
+                                    'VehicleNumber': f'{i}{brigade}',
+                                    'Lat': 52.2 + 0.01 * i + lat, 'Lon': 21 + 0.01 * stop,
+                                    'Time': f'2024-02-16 {seconds // 3600:02d}:'
+                                            f'{seconds // 60 % 60:02d}:{seconds % 60:02d}'})
+            path_to_bus_stops = os.path.join(data_dir, 'bus_stops.json')
+            path_to_schedule = os.path.join(data_dir, 'schedule.csv')
+            path_to_localizations = os.path.join(data_dir, 'buses.json')
+            pd.DataFrame(bus_stops).to_json(path_to_bus_stops, orient='records')
+            pd.DataFrame(schedule).to_csv(path_to_schedule)
+            pd.DataFrame(localizations).to_json(path_to_localizations, orient='records')
+
+            events = build_events(pd.DataFrame(localizations),
+                                  get_stops_of_lines(path_to_bus_stops, path_to_schedule))
+            key = ['Line', 'BusstopID', 'BusstopNr', 'Brigade', 'ScheduledTime']
+            delays = get_delays_from_events(events, path_to_schedule)
+            expected = get_delays(path_to_localizations, path_to_bus_stops, path_to_schedule)
+            expected['Line'] = expected['Line'].astype(str)
+            delays = delays.sort_values(key, ignore_index=True)
+            expected = expected.sort_values(key, ignore_index=True)
+            self.assertGreater(len(delays), 50)
+            for column in key + ['Time']:
+                self.assertEqual(delays[column].tolist(), expected[column].tolist())
+            self.assertEqual(delays['Delay'].round(6).tolist(),
+                             expected['Delay'].round(6).tolist())
+        finally:
+            shutil.rmtree(data_dir)
+
+    def test_update_events(self):
+        ''' Test update_events function. '''
+        events_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(events_dir, 'events-9.parquet')
+            update_events(PATH_TO_LOCALIZATIONS, path, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+            self.assertEqual(len(pd.read_parquet(path)), 4)
+            mtime = os.stat(path).st_mtime_ns
+            update_events(PATH_TO_LOCALIZATIONS, path, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+            self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        finally:
+            shutil.rmtree(events_dir)
+
+class TestSampling(unittest.TestCase):
+    ''' Test sampling.py module. '''
+
+    def setUp(self):
+        self.localizations = pd.DataFrame({
+            'VehicleNumber': [str(vehicle) for vehicle in range(20)],
+            'Lines': ['182'] * 10 + ['187'] * 9 + ['N22'],
+        })
+
+    def test_sample_vehicles(self):
+        ''' Test sample_vehicles function. '''
+        vehicles = sample_vehicles(self.localizations, 0.2)
+        sampled = vehicles[vehicles['InSample']].groupby('Stratum').size()
+        self.assertEqual(sampled.to_dict(), {'182': 2, '187': 2, 'N22': 1})
+        self.assertEqual(vehicles.set_index('VehicleNumber').loc['19', 'StratumSize'], 1)
+
+    def test_stratified_total(self):
+        ''' Test stratified_total function. '''
+        values = pd.DataFrame({'Overspeeding': [1] * 20},
+                              index=[str(vehicle) for vehicle in range(20)])
+        estimate = stratified_total(values, sample_vehicles(self.localizations, 1), 0.95)
+        self.assertEqual(estimate['Overspeeding'].value, 20)
+        self.assertEqual(estimate['Overspeeding'].low, 20)
+        self.assertEqual(estimate['Overspeeding'].high, 20)
+
+        vehicles = sample_vehicles(self.localizations, 0.5)
+        sampled = vehicles.loc[vehicles['InSample'], 'VehicleNumber']
+        values = pd.DataFrame({'Overspeeding': (sampled.astype(int) % 2).values},
+                              index=sampled.values)
+        estimate = stratified_total(values, vehicles, 0.95)['Overspeeding']
+        self.assertTrue(estimate.low <= estimate.value <= estimate.high)
+        self.assertTrue(estimate.high > estimate.low)
+
+    def test_estimate_delays(self):
+        ''' Test estimate_delays function. '''
+        delays, estimates = estimate_delays(PATH_TO_LOCALIZATIONS, PATH_TO_BUS_STOPS,
+                                            PATH_TO_SCHEDULE, 1)
+        self.assertEqual(len(delays), 4)
+        self.assertEqual(estimates['Count'].value, 4)
+        self.assertAlmostEqual(estimates['MeanDelay'].value, 19 / 6)
+        self.assertAlmostEqual(estimates['MeanDelay'].low, 19 / 6)
+
+class TestCleaning(unittest.TestCase):
+    ''' Test cleaning.py module. '''
+
+    def test_clean_localizations(self):
+        ''' Test clean_localizations function. '''
+        localizations = pd.read_json(PATH_TO_LOCALIZATIONS, dtype=False, convert_dates=False)
+        cleaned, report = clean_localizations(localizations)
+        self.assertEqual(len(cleaned), 4)
+        self.assertEqual(report, {'duplicate_reports': 4, 'stale': 0, 'jumps': 0})
+
+        track = pd.DataFrame({
+            'Lines': '182', 'Brigade': '1', 'VehicleNumber': '8',
+            'Lat': [52.2160, 52.2161, 52.3000, 52.2162, 52.2163, 52.2163],
+            'Lon': [20.9826, 20.9827, 20.9827, 20.9828, 20.9829, 20.9829],
+            'Time': ['2024-02-16 09:15:00', '2024-02-16 09:15:15', '2024-02-16 09:15:30',
+                     '2024-02-16 09:15:45', '2024-02-16 09:16:00', '2024-02-16 07:00:00'],
+        })
+        cleaned, report = clean_localizations(track)
+        self.assertEqual(report, {'duplicate_reports': 0, 'stale': 1, 'jumps': 1})
+        self.assertEqual(cleaned['Time'].tolist(), ['2024-02-16 09:15:00', '2024-02-16 09:15:15',
+                                                    '2024-02-16 09:15:45', '2024-02-16 09:16:00'])
+
+    def test_clean_jumps(self):
+        ''' Test removing spikes at the ends of tracks and spikes of several samples. '''
+        lat = [52.2160, 52.2161, 52.2162, 52.2163, 52.2164, 52.2165]
+        times = [f'2024-02-16 09:15:{second:02d}' for second in range(0, 60, 10)]
+        for spikes in [[5], [0], [2, 3], [4, 5]]:
+            track = pd.DataFrame({'Lines': '182', 'Brigade': '1', 'VehicleNumber': '8',
+                                  'Lat': [52.3 if i in spikes else value
+                                          for i, value in enumerate(lat)],
+                                  'Lon': 20.9826, 'Time': times})
+            cleaned, report = clean_localizations(track)
+            self.assertEqual(report['jumps'], len(spikes))
+            self.assertEqual(cleaned['Time'].tolist(),
+                             [time for i, time in enumerate(times) if i not in spikes])
+
+class TestLineStops(unittest.TestCase):
+    ''' Test line_stops.py module. '''
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.path_to_bus_stops = os.path.join(self.data_dir, 'bus_stops.json')
+        self.path_to_schedule = os.path.join(self.data_dir, 'schedule.csv')
+        shutil.copy(PATH_TO_BUS_STOPS, self.path_to_bus_stops)
+        shutil.copy(PATH_TO_SCHEDULE, self.path_to_schedule)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_line_bus_stops(self):
+        ''' Test line_bus_stops function. '''
+        line_stops = load_line_stops(self.path_to_bus_stops, self.path_to_schedule)
+        self.assertIs(line_stops, load_line_stops(self.path_to_bus_stops,
+                                                  self.path_to_schedule))
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, 'schedule.line-stops.pkl')))
+        stops = line_stops.line_bus_stops('N22')
+        self.assertEqual(stops['BusstopID'].tolist(), [4121])
+        self.assertEqual(stops['LatRound'].tolist(), [52.216])
+        self.assertTrue(line_stops.line_bus_stops('999').empty)
+
+    def test_stops_near(self):
+        ''' Test stops_near function. '''
+        line_stops = load_line_stops(self.path_to_bus_stops, self.path_to_schedule)
+        near = line_stops.stops_near('182', 52.2163576442883, 20.99128337964515, 700)
+        self.assertEqual(near['BusstopID'].tolist(), [4121])
+        self.assertTrue(500 < near['Distance'].values[0] < 700)
+        self.assertTrue(line_stops.stops_near('182', 52.2163576442883, 20.99128337964515,
+                                              300).empty)
+
+    def test_rebuild(self):
+        ''' Test rebuilding the bus stops of the lines after the bus stops change. '''
+        load_line_stops(self.path_to_bus_stops, self.path_to_schedule)
+        bus_stops = pd.read_json(self.path_to_bus_stops)
+        bus_stops['Latitude'] = 52.3
+        bus_stops.to_json(self.path_to_bus_stops, orient='records')
+        os.utime(self.path_to_bus_stops, ns=(1, 1))
+        stops = load_line_stops(self.path_to_bus_stops, self.path_to_schedule) \
+                    .line_bus_stops('182')
+        self.assertEqual(stops['Latitude'].tolist(), [52.3])
+
+    def write_snapshots(self, version: int, latitude: float, longitude: float, diff: dict):
+        '''
+        Write the bus stops, the schedule and the snapshots as left by fetch_schedules.py.
+
+        Line 182 also stops at 7000/01, which is at the given coordinates.
+
+        '''
+        bus_stops = pd.read_json(PATH_TO_BUS_STOPS)
+        bus_stops = pd.concat([bus_stops, pd.DataFrame({
+            'BusstopID': [7000], 'BusstopNr': [1], 'Latitude': [latitude],
+            'Longitude': [longitude], 'Direction': ['Wola']})], ignore_index=True)
+        bus_stops.to_json(self.path_to_bus_stops, orient='records')
+        schedule = pd.read_csv(PATH_TO_SCHEDULE)
+        schedule = pd.concat([schedule, pd.DataFrame({
+            'Line': ['182'], 'BusstopID': [7000], 'BusstopNr': [1], 'Time': ['09:15:00'],
+            'Brigade': [1], 'Direction': ['Wola']})], ignore_index=True)
+        schedule.to_csv(self.path_to_schedule, index=False)
+        for i, path in enumerate([self.path_to_bus_stops, self.path_to_schedule]):
+            os.utime(path, ns=(version * 10 + i, version * 10 + i))
+
+        snapshots_dir = os.path.join(self.data_dir, 'bus_stops_snapshots')
+        os.makedirs(snapshots_dir, exist_ok=True)
+        for name, content in [(f'snapshot-{version}.json', {'version': version}),
+                              (f'diff-{version}.json', diff),
+                              ('schedule.json', {'version': version, 'crawled': '2024-02-16'})]:
+            with open(os.path.join(snapshots_dir, name), 'w', encoding='utf-8') as f:
+                json.dump(content, f)
+
+    def test_update(self):
+        ''' Test rebuilding only the lines using the bus stops from the snapshot diffs. '''
+        moved = {'added': [], 'removed': [], 'changed': [],
+                 'moved': [{'BusstopID': '7000', 'BusstopNr': '01'}]}
+        self.write_snapshots(1, 52.3, 21.1, dict(moved, moved=[]))
+        old = load_line_stops(self.path_to_bus_stops, self.path_to_schedule)
+        old_state = snapshots_state(self.path_to_bus_stops)
+        self.assertEqual(old.state, old_state)
+        unchanged = old.line_bus_stops('523')
+
+        self.write_snapshots(2, 52.216358, 20.991283, moved)
+        state = snapshots_state(self.path_to_bus_stops)
+        affected = affected_stops(self.path_to_bus_stops, old_state, state)
+        self.assertEqual(affected, {(7000, 1)})
+        self.assertIsNone(affected_stops(self.path_to_bus_stops, state, state))
+        self.assertIsNone(affected_stops(self.path_to_bus_stops, old_state,
+                                         dict(state, crawled='2024-02-17')))
+        old.update(self.path_to_bus_stops, self.path_to_schedule, affected, state)
+        self.assertIs(old.line_bus_stops('523'), unchanged)
+
+        updated = load_line_stops(self.path_to_bus_stops, self.path_to_schedule)
+        expected = LineStops(self.path_to_bus_stops, self.path_to_schedule)
+        self.assertEqual(updated.state, state)
+        self.assertEqual(sorted(updated.stops), sorted(expected.stops))
+        for line, stops in expected.stops.items():
+            pd.testing.assert_frame_equal(updated.line_bus_stops(line), stops)
+            self.assertEqual(updated.grids[line].keys(), expected.grids[line].keys())
+        self.assertEqual(len(updated.stops_near('182', 52.216358, 20.991283, 10)), 1)
+
+    def test_update_events(self):
+        ''' Test building again only the events of the lines using the changed bus stops. '''
+        moved = {'added': [], 'removed': [], 'changed': [],
+                 'moved': [{'BusstopID': '7000', 'BusstopNr': '01'}]}
+        path = os.path.join(self.data_dir, 'events-9.parquet')
+        self.write_snapshots(1, 52.3, 21.1, dict(moved, moved=[]))
+        update_events(PATH_TO_LOCALIZATIONS, path, self.path_to_bus_stops, self.path_to_schedule)
+        self.assertEqual(len(pd.read_parquet(path)), 4)
+
+        self.write_snapshots(2, 52.216358, 20.991283, moved)
+        update_events(PATH_TO_LOCALIZATIONS, path, self.path_to_bus_stops, self.path_to_schedule)
+        events = pd.read_parquet(path)
+        localizations = pd.read_json(PATH_TO_LOCALIZATIONS, dtype=False, convert_dates=False)
+        expected = build_events(localizations, get_stops_of_lines(self.path_to_bus_stops,
+                                                                  self.path_to_schedule))
+        key = ['Line', 'BusstopID', 'Arrival']
+        pd.testing.assert_frame_equal(events.sort_values(key, ignore_index=True),
+                                      expected.sort_values(key, ignore_index=True),
+                                      check_dtype=False)
+        self.assertEqual(events[events['BusstopID'] == 7000]['Line'].tolist(), ['182'])
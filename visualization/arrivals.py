@@ -0,0 +1,237 @@
+''' Stop arrival events materialized from bus localizations. '''
+import json
+import os
+from typing import Iterable
+import numpy as np
+import pandas as pd
+from .cache import read_signature, source_signature, write_signature
+from .compact_schedule import load_schedule, time_to_seconds
+from .line_stops import affected_stops, load_line_stops, snapshots_state, stop_keys
+from .utils import MAX_DELAY, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE
+
+EVENTS_DIR = 'data/events'
+MAX_VISIT_GAP = 120 # seconds between samples of the same stop visit
+
+EVENT_COLUMNS = ['Line', 'Brigade', 'VehicleNumber', 'BusstopID', 'BusstopNr',
+                 'Arrival', 'Departure', 'Samples']
+
+def get_stops_of_lines(path_to_bus_stops: str, path_to_schedule: str) -> pd.DataFrame:
+    '''
+    Get the bus stops of all the lines with rounded coordinates.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    '''
+    line_stops = load_line_stops(path_to_bus_stops, path_to_schedule)
+    line_stops = pd.concat([stops[['BusstopID', 'BusstopNr', 'LatRound', 'LonRound']]
+                            .assign(Line=str(line))
+                            for line, stops in line_stops.stops.items()], ignore_index=True)
+    return line_stops.dropna(subset=['LatRound', 'LonRound']).drop_duplicates()
+
+def build_events(localizations: pd.DataFrame, line_stops: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Find the visits of vehicles at the stops of their lines.
+
+    Consecutive samples of a vehicle near the same stop make one visit
+    with the time of arrival and departure.
+
+    :param localizations: DataFrame with bus localizations.
+
+    :param line_stops: Bus stops of the lines, as returned by get_stops_of_lines.
+
+    '''
+    localizations = localizations[['Lines', 'Brigade', 'VehicleNumber',
+                                   'Lat', 'Lon', 'Time']].copy()
+    localizations['Line'] = localizations['Lines'].astype(str)
+    localizations['LatRound'] = localizations['Lat'].round(4)
+    localizations['LonRound'] = localizations['Lon'].round(4)
+    localizations['Time'] = pd.to_datetime(localizations['Time'], format='%Y-%m-%d %H:%M:%S')
+
+    samples = pd.merge(localizations, line_stops, on=['Line', 'LatRound', 'LonRound'],
+                       how='inner')
+    if samples.empty:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+    key = ['VehicleNumber', 'Line', 'Brigade', 'BusstopID', 'BusstopNr']
+    samples = samples.sort_values(key + ['Time'], ignore_index=True)
+
+    new_key = np.zeros(len(samples), dtype=bool)
+    new_key[0] = True
+    for column in key:
+        values = samples[column].values
+        new_key[1:] |= values[1:] != values[:-1]
+    gap = np.diff(samples['Time'].values, prepend=samples['Time'].values[:1]) \
+          > np.timedelta64(MAX_VISIT_GAP, 's')
+    samples['Visit'] = np.cumsum(new_key | gap)
+
+    events = samples.groupby('Visit').agg(**{column: (column, 'first') for column in key},
+                                          Arrival=('Time', 'min'),
+                                          Departure=('Time', 'max'),
+                                          Samples=('Time', 'size'))
+    events['Brigade'] = events['Brigade'].astype(str)
+    events['VehicleNumber'] = events['VehicleNumber'].astype(str)
+    return events.sort_values('Arrival', ignore_index=True)[EVENT_COLUMNS]
+
+def update_events(path_to_localizations: str, path_to_events: str,
+                  path_to_bus_stops: str, path_to_schedule: str):
+    '''
+    Build the events from the localizations and save them,
+    unless they were built from the same input files.
+
+    When the bus stops and the schedule changed only by the diffs of the bus stop
+    snapshots, only the events of the lines using the changed stops are built again.
+
+    :param path_to_localizations: Path to the file with bus localizations.
+
+    :param path_to_events: Path to the events file.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    '''
+    signature = source_signature([path_to_localizations, path_to_bus_stops, path_to_schedule])
+    path_to_signature = f'{path_to_events}.source.json'
+    saved = read_signature(path_to_signature) if os.path.exists(path_to_events) else None
+    if not isinstance(saved, dict):
+        saved = {}
+    if saved.get('sources') == signature:
+        return
+
+    state = snapshots_state(path_to_bus_stops)
+    affected = None
+    if saved.get('sources', [None])[0] == signature[0]:
+        affected = affected_stops(path_to_bus_stops, saved.get('snapshots'), state)
+    with open(path_to_localizations, 'r', encoding='utf-8') as f:
+        localizations = pd.DataFrame(json.load(f))
+    line_stops = get_stops_of_lines(path_to_bus_stops, path_to_schedule)
+    if affected is None:
+        events = build_events(localizations, line_stops)
+    else:
+        events = pd.read_parquet(path_to_events)
+        affected = list(affected)
+        lines = set(events['Line'][stop_keys(events).isin(affected)])
+        lines |= set(line_stops['Line'][stop_keys(line_stops).isin(affected)])
+        rebuilt = build_events(localizations[localizations['Lines'].astype(str).isin(lines)],
+                               line_stops[line_stops['Line'].isin(lines)])
+        events = events[~events['Line'].isin(lines)]
+        if not rebuilt.empty:
+            events = pd.concat([events, rebuilt], ignore_index=True)
+        events = events.sort_values('Arrival', ignore_index=True)
+
+    directory = os.path.dirname(path_to_events)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    events.to_parquet(path_to_events, index=False)
+    write_signature(path_to_signature, {'sources': signature, 'snapshots': state})
+
+def build_events_from_hour(hour: int, events_dir: str = EVENTS_DIR) -> str:
+    '''
+    Build the events from the given hour if needed and return the path to the events file.
+
+    :param hour: Hour of the day.
+
+    :param events_dir: Directory with the events files.
+
+    '''
+    path = os.path.join(events_dir, f'events-{hour}.parquet')
+    update_events(f'data/buses-{hour}.json', path, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+    return path
+
+def load_events(hours: Iterable[int], events_dir: str = EVENTS_DIR) -> pd.DataFrame:
+    '''
+    Load the events from the given hours, building the missing ones.
+
+    :param hours: Hours of the day.
+
+    :param events_dir: Directory with the events files.
+
+    '''
+    events = [pd.read_parquet(build_events_from_hour(hour, events_dir)) for hour in hours]
+    return pd.concat(events, ignore_index=True)
+
+def get_delays_from_events(events: pd.DataFrame, path_to_schedule: str,
+                           max_delay: float = MAX_DELAY) -> pd.DataFrame:
+    '''
+    For each arrival, get the last scheduled time before it and the delay in minutes.
+
+    :param events: DataFrame with arrival events.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param max_delay: Delays in minutes from this value up are ignored.
+
+    '''
+    key = ['Line', 'BusstopID', 'BusstopNr', 'Brigade']
+    schedule = load_schedule(path_to_schedule).lines_schedule(events['Line'].unique())
+    schedule['Line'] = schedule['Line'].astype(str)
+    # brigades are compared as numbers, as in get_stop_schedule, so '01' matches 1
+    schedule['Brigade'] = schedule['Brigade'].astype(int)
+    # the time of day is compared, as in get_stop_schedule
+    schedule['Seconds'] = time_to_seconds(schedule['Time']) % 86400
+    schedule['ScheduledSeconds'] = schedule['Seconds']
+
+    arrivals = events.copy()
+    arrivals['Brigade'] = arrivals['Brigade'].astype(int)
+    arrival_times = pd.to_datetime(arrivals['Arrival'])
+    arrivals['Seconds'] = (arrival_times - arrival_times.dt.normalize()).dt.total_seconds() \
+                          .astype(np.int64)
+    arrivals['Time'] = arrival_times.dt.time
+
+    delays = pd.merge_asof(arrivals.sort_values('Seconds'),
+                           schedule[key + ['Direction', 'Seconds', 'ScheduledSeconds']]
+                           .sort_values('Seconds'),
+                           on='Seconds', by=key, direction='backward',
+                           allow_exact_matches=False)
+    delays = delays.dropna(subset=['ScheduledSeconds'])
+    delays['Delay'] = (delays['Seconds'] - delays['ScheduledSeconds']) / 60
+    delays = delays[delays['Delay'] < max_delay]
+    delays['ScheduledTime'] = pd.to_datetime(delays['ScheduledSeconds'], unit='s').dt.time
+    delays = delays.drop_duplicates(subset=['BusstopID', 'BusstopNr', 'Brigade', 'Line',
+                                            'ScheduledTime'], keep='first')
+    return delays[key + ['Direction', 'ScheduledTime', 'Time', 'Delay']] \
+           .reset_index(drop=True)
+
+def get_delays_from_events_file(path_to_events: str, path_to_schedule: str,
+                                max_delay: float = MAX_DELAY) -> pd.DataFrame:
+    '''
+    For each arrival in the events file, get the last scheduled time before it
+    and the delay in minutes.
+
+    :param path_to_events: Path to the events file.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param max_delay: Delays in minutes from this value up are ignored.
+
+    '''
+    return get_delays_from_events(pd.read_parquet(path_to_events), path_to_schedule, max_delay)
+
+def get_dwell_times(events: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Get the time in seconds spent by vehicles at each visited stop.
+
+    :param events: DataFrame with arrival events.
+
+    '''
+    events = events.copy()
+    events['Dwell'] = (pd.to_datetime(events['Departure'])
+                       - pd.to_datetime(events['Arrival'])).dt.total_seconds()
+    return events
+
+def get_headways(events: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Get the time in minutes since the previous arrival of the same line at the same stop.
+
+    Small headways indicate bunching. The first arrival at each stop has no headway.
+
+    :param events: DataFrame with arrival events.
+
+    '''
+    events = events.sort_values(['Line', 'BusstopID', 'BusstopNr', 'Arrival'],
+                                ignore_index=True)
+    previous = events.groupby(['Line', 'BusstopID', 'BusstopNr'])['Arrival'].shift(1)
+    events['Headway'] = (pd.to_datetime(events['Arrival'])
+                         - pd.to_datetime(previous)).dt.total_seconds() / 60
+    return events
@@ -0,0 +1,253 @@
+''' Caches of results derived from the data files.
+
+The results of the per-hour analyses are content-addressed. Files derived
+from the schedule and the bus stops are saved with the signature of their
+sources and rebuilt whenever the signature changes.
+'''
+import hashlib
+import json
+import os
+import pickle
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+CACHE_DIR = 'data/cache'
+MAX_CACHE_SIZE = 512 * 1024 * 1024 # bytes
+# part of every key, bump it whenever a change in the code changes the results of the analyses
+CACHE_VERSION = 2
+
+# digests of already hashed files, keyed by path, size and modification time
+_DIGESTS: Dict[Tuple[str, int, int], str] = {}
+
+def file_digest(path: str) -> str:
+    '''
+    Get the SHA-256 digest of the file content.
+
+    The digest is remembered for the process as long as the size and
+    the modification time of the file do not change.
+
+    :param path: Path to the file.
+
+    '''
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if signature not in _DIGESTS:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        _DIGESTS[signature] = sha.hexdigest()
+    return _DIGESTS[signature]
+
+def make_key(name: str, paths: List[str], params: Dict[str, Any], version: int = 0) -> str:
+    '''
+    Make the cache key for the analysis of the given input files.
+
+    :param name: Name of the analysis.
+
+    :param paths: Paths to the input files.
+
+    :param params: Parameters of the analysis.
+
+    :param version: Version of the analysis, results of other versions are not reused.
+
+    '''
+    key = {
+        'cache_version': CACHE_VERSION,
+        'name': name,
+        'version': version,
+        'files': [file_digest(path) for path in paths],
+        'params': params,
+    }
+    key = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def load(key: str, cache_dir: str = CACHE_DIR) -> Tuple[bool, Any]:
+    '''
+    Load the cached result, returns a pair (found, result).
+
+    :param key: Cache key.
+
+    :param cache_dir: Directory with cached results.
+
+    '''
+    path = os.path.join(cache_dir, f'{key}.pkl')
+    try:
+        result = _unpickle(path)
+    except OSError:
+        return False, None
+    os.utime(path) # mark as recently used
+    return True, result
+
+def _unpickle(path: str) -> Any:
+    '''
+    Load the pickled object from the file.
+
+    A file that cannot be unpickled, e.g. written by another version of pandas
+    or referring to a class that was moved, raises OSError like a missing one.
+
+    :param path: Path to the file.
+
+    '''
+    with open(path, 'rb') as f:
+        try:
+            return pickle.load(f)
+        except Exception as e: # unpickling can raise almost any exception
+            raise OSError(f'Cannot unpickle {path}: {e!r}') from e
+
+def evict(cache_dir: str = CACHE_DIR, max_size: int = MAX_CACHE_SIZE):
+    '''
+    Remove the least recently used results until the cache fits in max_size bytes.
+
+    :param cache_dir: Directory with cached results.
+
+    :param max_size: Maximum size of the cache in bytes.
+
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith('.pkl'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+def store(key: str, result: Any, cache_dir: str = CACHE_DIR, max_size: int = MAX_CACHE_SIZE):
+    '''
+    Save the result in the cache.
+
+    :param key: Cache key.
+
+    :param result: Result to save.
+
+    :param cache_dir: Directory with cached results.
+
+    :param max_size: Maximum size of the cache in bytes.
+
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, f'{key}.pkl')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path) # readers never see partially written results
+    evict(cache_dir, max_size)
+
+def cached_call(func: Callable[..., Any], paths: List[str], params: Dict[str, Any],
+                cache_dir: str = CACHE_DIR, max_size: int = MAX_CACHE_SIZE,
+                version: int = 0) -> Any:
+    '''
+    Call func(*paths, **params) or return its cached result.
+
+    The result is recomputed whenever any of the input files, parameters,
+    the version of the analysis or CACHE_VERSION change.
+
+    :param func: Analysis to run.
+
+    :param paths: Paths to the input files, passed to func as positional arguments.
+
+    :param params: Parameters of the analysis, passed to func as keyword arguments.
+
+    :param cache_dir: Directory with cached results.
+
+    :param max_size: Maximum size of the cache in bytes.
+
+    :param version: Version of the analysis, bump it when func starts returning other results.
+
+    '''
+    key = make_key(f'{func.__module__}.{func.__qualname__}', paths, params, version)
+    found, result = load(key, cache_dir)
+    if not found:
+        result = func(*paths, **params)
+        store(key, result, cache_dir, max_size)
+    return result
+
+# results of load_derived, keyed by the saved file and the signature of its sources
+_DERIVED: Dict[Tuple[str, str], Any] = {}
+
+def source_signature(paths: List[str]) -> List[list]:
+    '''
+    Get the signature of the source files, which changes whenever any of them changes.
+
+    :param paths: Paths to the source files.
+
+    '''
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+def read_signature(path: str) -> Any:
+    '''
+    Read the signature saved by write_signature, None if there is none.
+
+    :param path: Path to the signature file.
+
+    '''
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_signature(path: str, signature: Any):
+    '''
+    Save the signature of the sources of a derived file.
+
+    It should be saved after the derived file, so an interrupted build is repeated.
+
+    :param path: Path to the signature file.
+
+    :param signature: Signature, e.g. as returned by source_signature.
+
+    '''
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(signature, f)
+    os.replace(tmp_path, path)
+
+def load_derived(path: str, sources: List[str], build: Callable[[], Any],
+                 update: Optional[Callable[[Any], Any]] = None) -> Any:
+    '''
+    Load the result derived from the source files, building and saving it
+    when it was not saved yet or any of the sources changed.
+
+    The result is also remembered for the process.
+
+    :param path: Path to the saved result.
+
+    :param sources: Paths to the source files.
+
+    :param build: Function building the result.
+
+    :param update: Function updating the result saved before the sources changed,
+                   returns None if it cannot be updated and must be built again.
+
+    '''
+    signature = source_signature(sources)
+    key = (os.path.abspath(path), json.dumps(signature))
+    if key in _DERIVED:
+        return _DERIVED[key]
+
+    found, saved = False, None
+    try:
+        saved_signature, saved = _unpickle(path)
+        found = saved_signature == signature
+    except (OSError, TypeError, ValueError):
+        pass
+    result = saved
+    if not found:
+        result = update(saved) if update is not None and saved is not None else None
+        if result is None:
+            result = build()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((signature, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    _DERIVED[key] = result
+    return result
@@ -0,0 +1,126 @@
+''' Vectorized cleaning of bus localizations before computing speeds. '''
+from typing import Dict, Tuple
+import numpy as np
+import pandas as pd
+from .utils import calculate_distances
+
+MAX_PLAUSIBLE_SPEED = 120 # km/h
+MAX_SAMPLE_AGE = 3600 # seconds before the typical sample time
+
+def clean_localizations(localizations: pd.DataFrame,
+                        max_speed: float = MAX_PLAUSIBLE_SPEED,
+                        max_age: float = MAX_SAMPLE_AGE) \
+                        -> Tuple[pd.DataFrame, Dict[str, int]]:
+    '''
+    Remove samples that would produce spurious speeds.
+
+    Returns the cleaned localizations sorted by vehicle and time,
+    and the number of rows removed by each rule:
+
+    - duplicate_reports: the same vehicle reported at the same time more than once,
+      e.g. under several lines,
+    - stale: samples with an invalid time or older than max_age seconds
+      before the median time of all the samples,
+    - jumps: samples reachable only faster than max_speed from the samples kept around them,
+      see plausible_track, in tracks of at least three samples.
+
+    :param localizations: DataFrame with bus localizations.
+
+    :param max_speed: Speed in km/h above which a move is physically implausible.
+
+    :param max_age: Age in seconds above which a sample is stale.
+
+    '''
+    report: Dict[str, int] = {}
+    data = localizations.copy()
+    times = pd.to_datetime(data['Time'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    data['Seconds'] = times.values.astype('datetime64[s]').astype(np.int64)
+    data['Valid'] = times.notna().values
+
+    rows = len(data)
+    data = data.drop_duplicates(['VehicleNumber', 'Time'])
+    report['duplicate_reports'] = rows - len(data)
+
+    rows = len(data)
+    valid = data['Valid'].values
+    median = np.median(data['Seconds'].values[valid]) if valid.any() else 0
+    data = data[valid & (data['Seconds'].values >= median - max_age)]
+    report['stale'] = rows - len(data)
+
+    rows = len(data)
+    data = data.sort_values(['VehicleNumber', 'Seconds'], kind='stable')
+    vehicles = data['VehicleNumber'].values
+    lat = data['Lat'].values
+    lon = data['Lon'].values
+    seconds = data['Seconds'].values
+
+    same_vehicle = vehicles[1:] == vehicles[:-1]
+    implausible = same_vehicle & _implausible(lat[:-1], lon[:-1], seconds[:-1],
+                                              lat[1:], lon[1:], seconds[1:], max_speed)
+    keep = np.ones(len(data), dtype=bool)
+    # only the tracks with an implausible move are checked sample by sample,
+    # with two samples it is unknown which one is wrong
+    starts = np.flatnonzero(np.concatenate([[True], ~same_vehicle]))
+    ends = np.append(starts[1:], len(data))
+    for start, end in zip(starts, ends):
+        if end - start > 2 and implausible[start:end - 1].any():
+            keep[start:end] = plausible_track(lat[start:end], lon[start:end],
+                                              seconds[start:end], max_speed)
+    data = data[keep]
+    report['jumps'] = rows - len(data)
+
+    return data.drop(columns=['Seconds', 'Valid']), report
+
+def _implausible(lat1: np.ndarray, lon1: np.ndarray, seconds1: np.ndarray,
+                 lat2: np.ndarray, lon2: np.ndarray, seconds2: np.ndarray,
+                 max_speed: float) -> np.ndarray:
+    ''' Check which moves would have to be faster than max_speed. '''
+    distances = calculate_distances(lat1, lon1, lat2, lon2)
+    return distances > max_speed * np.abs(seconds2 - seconds1) / 3600
+
+def plausible_track(lat: np.ndarray, lon: np.ndarray, seconds: np.ndarray,
+                    max_speed: float = MAX_PLAUSIBLE_SPEED) -> np.ndarray:
+    '''
+    Find the samples of one vehicle which form a physically plausible track.
+
+    The longest run of consecutive plausible moves is trusted. Going forward
+    and backward from its start, a sample is kept if it is reachable from
+    the last kept one, so runs of implausible samples are dropped,
+    including those at the start or the end of the track.
+
+    Returns a mask of the samples to keep.
+
+    :param lat: Latitudes of the samples, sorted by time.
+
+    :param lon: Longitudes of the samples, sorted by time.
+
+    :param seconds: Times of the samples in seconds.
+
+    :param max_speed: Speed in km/h above which a move is physically implausible.
+
+    '''
+    implausible = _implausible(lat[:-1], lon[:-1], seconds[:-1],
+                               lat[1:], lon[1:], seconds[1:], max_speed)
+    runs = np.concatenate([[0], np.cumsum(implausible)])
+    reference = int(np.flatnonzero(runs == np.argmax(np.bincount(runs)))[0])
+
+    keep = np.zeros(len(lat), dtype=bool)
+    keep[reference] = True
+    for direction in (1, -1):
+        anchor = reference
+        for i in range(reference + direction, len(lat) if direction > 0 else -1, direction):
+            if not _implausible(lat[anchor], lon[anchor], seconds[anchor],
+                                lat[i], lon[i], seconds[i], max_speed):
+                keep[i] = True
+                anchor = i
+    return keep
+
+def format_report(report: Dict[str, int]) -> str:
+    '''
+    Describe the numbers of samples removed by clean_localizations.
+
+    :param report: Numbers of removed samples, as returned by clean_localizations.
+
+    '''
+    details = ', '.join(f'{count} {rule}' for rule, count in report.items())
+    return f'Removed {sum(report.values())} samples: {details}'
@@ -0,0 +1,270 @@
+''' Compact schedule made of trip patterns and trip start times. '''
+import os
+from typing import Dict, Iterable, Optional, Tuple
+import numpy as np
+import pandas as pd
+from .cache import load_derived
+
+def time_to_seconds(times: pd.Series) -> np.ndarray:
+    '''
+    Convert schedule times (HH:MM:SS, hours may exceed 23) to seconds after midnight.
+
+    :param times: Schedule times.
+
+    '''
+    return (pd.to_timedelta(times).values // np.timedelta64(1, 's')).astype(np.int64)
+
+def seconds_to_time(seconds: np.ndarray) -> np.ndarray:
+    '''
+    Convert seconds after midnight to schedule times (HH:MM:SS).
+
+    :param seconds: Seconds after midnight.
+
+    '''
+    seconds = pd.Series(seconds)
+    return (seconds // 3600).astype(str).str.zfill(2) + ':' \
+           + (seconds // 60 % 60).astype(str).str.zfill(2) + ':' \
+           + (seconds % 60).astype(str).str.zfill(2)
+
+def split_trips(groups: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    '''
+    Number the trips of rows sorted by trip key and time.
+
+    A new trip starts when the trip key changes or the stop was already visited.
+
+    :param groups: Code of the trip key of each row.
+
+    :param stops: Code of the stop of each row.
+
+    '''
+    trips = np.empty(len(groups), dtype=np.int64)
+    trip = -1
+    previous_group = None
+    visited: set = set()
+    for i, (group, stop) in enumerate(zip(groups.tolist(), stops.tolist())):
+        if group != previous_group or stop in visited:
+            trip += 1
+            previous_group = group
+            visited = set()
+        visited.add(stop)
+        trips[i] = trip
+    return trips
+
+class CompactSchedule:
+    '''
+    Schedule stored as trip patterns (line, direction, stop sequence and offsets
+    from the first stop) and trips (pattern, brigade and start time).
+    '''
+    def __init__(self, schedule: pd.DataFrame):
+        '''
+        Compress the schedule.
+
+        :param schedule: Schedule with one row per line, bus stop, brigade and time.
+
+        '''
+        schedule = schedule.drop(columns=['Unnamed: 0'], errors='ignore')
+        self.columns = list(schedule.columns)
+
+        line_codes, self.lines = pd.factorize(schedule['Line'], use_na_sentinel=False)
+        brigade_codes, self.brigades = pd.factorize(schedule['Brigade'], use_na_sentinel=False)
+        direction_codes, self.directions = pd.factorize(schedule['Direction'],
+                                                        use_na_sentinel=False)
+        stops = pd.MultiIndex.from_arrays([schedule['BusstopID'], schedule['BusstopNr']])
+        stop_codes, stop_values = pd.factorize(stops, use_na_sentinel=False)
+        self.busstop_ids = stop_values.get_level_values(0).values
+        self.busstop_nrs = stop_values.get_level_values(1).values
+        seconds = time_to_seconds(schedule['Time'])
+
+        order = np.lexsort((seconds, direction_codes, brigade_codes, line_codes))
+        groups = (line_codes[order].astype(np.int64) * len(self.brigades)
+                  + brigade_codes[order]) * len(self.directions) + direction_codes[order]
+        trip_codes = split_trips(groups, stop_codes[order])
+        starts = np.flatnonzero(np.diff(trip_codes, prepend=-1))
+        lengths = np.diff(np.append(starts, len(order)))
+        trip_starts = np.repeat(seconds[order][starts], lengths)
+        offsets = seconds[order] - trip_starts
+        trip_stops = stop_codes[order]
+
+        patterns: Dict[Tuple, int] = {}
+        trip_patterns = np.empty(len(starts), dtype=np.int32)
+        pattern_lines, pattern_directions, flat_stops, flat_offsets = [], [], [], []
+        for trip, (start, length) in enumerate(zip(starts.tolist(), lengths.tolist())):
+            row = order[start]
+            key = (line_codes[row], direction_codes[row],
+                   tuple(trip_stops[start:start + length].tolist()),
+                   tuple(offsets[start:start + length].tolist()))
+            if key not in patterns:
+                patterns[key] = len(patterns)
+                pattern_lines.append(key[0])
+                pattern_directions.append(key[1])
+                flat_stops.extend(key[2])
+                flat_offsets.extend(key[3])
+            trip_patterns[trip] = patterns[key]
+
+        self.pattern_lines = np.array(pattern_lines, dtype=np.int32)
+        self.pattern_directions = np.array(pattern_directions, dtype=np.int32)
+        pattern_lengths = np.array([len(key[2]) for key in patterns], dtype=np.int64)
+        self.pattern_starts = np.concatenate([[0], np.cumsum(pattern_lengths)])
+        self.pattern_stops = np.array(flat_stops, dtype=np.int32)
+        self.pattern_offsets = np.array(flat_offsets, dtype=np.int32)
+
+        trip_brigades = brigade_codes[order][starts].astype(np.int32)
+        trip_times = seconds[order][starts].astype(np.int32)
+        trip_order = np.lexsort((trip_times, trip_brigades, trip_patterns))
+        self.trip_patterns = trip_patterns[trip_order]
+        self.trip_brigades = trip_brigades[trip_order]
+        self.trip_starts = trip_times[trip_order]
+
+        self._stop_positions: Optional[Dict[int, np.ndarray]] = None
+        self._stop_codes: Dict[Tuple, int] = {}
+        self._brigade_codes: Dict[str, int] = {}
+        self._line_codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        lengths = np.diff(self.pattern_starts)
+        return int(lengths[self.trip_patterns].sum())
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_stop_positions'] = None
+        state['_stop_codes'] = {}
+        state['_brigade_codes'] = {}
+        state['_line_codes'] = {}
+        return state
+
+    @classmethod
+    def from_csv(cls, path_to_schedule: str) -> 'CompactSchedule':
+        '''
+        Compress the schedule from the csv file.
+
+        :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+        '''
+        return cls(pd.read_csv(path_to_schedule, low_memory=False))
+
+    def expand(self, trips: np.ndarray) -> pd.DataFrame:
+        '''
+        Expand the given trips to the schedule rows.
+
+        :param trips: Indices of the trips.
+
+        '''
+        patterns = self.trip_patterns[trips]
+        lengths = np.diff(self.pattern_starts)[patterns]
+        first = np.repeat(self.pattern_starts[patterns], lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = first + within
+        stops = self.pattern_stops[positions]
+        rows = {
+            'Line': self.lines[np.repeat(self.pattern_lines[patterns], lengths)],
+            'BusstopID': self.busstop_ids[stops],
+            'BusstopNr': self.busstop_nrs[stops],
+            'Brigade': self.brigades[np.repeat(self.trip_brigades[trips], lengths)],
+            'Direction': self.directions[np.repeat(self.pattern_directions[patterns], lengths)],
+            'Time': seconds_to_time(np.repeat(self.trip_starts[trips], lengths)
+                                    + self.pattern_offsets[positions]).values,
+        }
+        return pd.DataFrame(rows, columns=self.columns)
+
+    def to_frame(self) -> pd.DataFrame:
+        ''' Expand the whole schedule to rows. '''
+        return self.expand(np.arange(len(self.trip_patterns)))
+
+    def line_schedule(self, line: str) -> pd.DataFrame:
+        '''
+        Get the schedule rows of the given line.
+
+        :param line: Bus line number.
+
+        '''
+        return self.lines_schedule([line])
+
+    def lines_schedule(self, lines: Iterable[str]) -> pd.DataFrame:
+        '''
+        Get the schedule rows of the given lines.
+
+        :param lines: Bus line numbers.
+
+        '''
+        line_codes = np.flatnonzero(np.isin(self.lines, list(lines)))
+        patterns = np.flatnonzero(np.isin(self.pattern_lines, line_codes))
+        return self.expand(np.flatnonzero(np.isin(self.trip_patterns, patterns)))
+
+    def line_stops(self) -> pd.DataFrame:
+        ''' Get the distinct pairs of line and bus stop, without expanding the trips. '''
+        lengths = np.diff(self.pattern_starts)
+        pairs = pd.DataFrame({'Line': np.repeat(self.pattern_lines, lengths),
+                              'Stop': self.pattern_stops}).drop_duplicates()
+        return pd.DataFrame({'Line': self.lines[pairs['Line'].values],
+                             'BusstopID': self.busstop_ids[pairs['Stop'].values],
+                             'BusstopNr': self.busstop_nrs[pairs['Stop'].values]})
+
+    def next_departure(self, line: str, busstop_id, busstop_nr, brigade,
+                       after: str) -> Optional[str]:
+        '''
+        Get the first scheduled time after the given one, None if there is no such time.
+
+        :param line: Bus line number.
+
+        :param busstop_id: ID of the bus stop.
+
+        :param busstop_nr: Number of the bus stop.
+
+        :param brigade: Brigade of the line.
+
+        :param after: Time (HH:MM:SS).
+
+        '''
+        if self._stop_positions is None:
+            self._build_index()
+
+        stop = self._stop_codes.get((busstop_id, busstop_nr))
+        brigade_code = self._brigade_codes.get(str(brigade))
+        line_code = self._line_codes.get(line)
+        if stop is None or brigade_code is None or line_code is None:
+            return None
+
+        positions = self._stop_positions[stop]
+        patterns = np.searchsorted(self.pattern_starts, positions, side='right') - 1
+        on_line = self.pattern_lines[patterns] == line_code
+        hours, minutes, seconds = after.split(':')
+        after_seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+        best = None
+        for pattern, position in zip(patterns[on_line], positions[on_line]):
+            # trips are sorted by pattern, brigade and start time
+            first = np.searchsorted(self.trip_patterns, pattern)
+            last = np.searchsorted(self.trip_patterns, pattern, side='right')
+            brigades = self.trip_brigades[first:last]
+            start = first + np.searchsorted(brigades, brigade_code)
+            end = first + np.searchsorted(brigades, brigade_code, side='right')
+            times = self.trip_starts[start:end] + self.pattern_offsets[position]
+            index = np.searchsorted(times, after_seconds, side='right')
+            if index < len(times) and (best is None or times[index] < best):
+                best = int(times[index])
+        if best is None:
+            return None
+        return f'{best // 3600:02d}:{best // 60 % 60:02d}:{best % 60:02d}'
+
+    def _build_index(self):
+        ''' Build the lookups used by next_departure. '''
+        order = np.argsort(self.pattern_stops, kind='stable')
+        bounds = np.flatnonzero(np.diff(self.pattern_stops[order], prepend=-1))
+        self._stop_positions = dict(zip(self.pattern_stops[order][bounds].tolist(),
+                                        np.split(order, bounds[1:])))
+        self._stop_codes = {stop: code for code, stop
+                            in enumerate(zip(self.busstop_ids, self.busstop_nrs))}
+        self._brigade_codes = {str(brigade): code for code, brigade in enumerate(self.brigades)}
+        self._line_codes = {line: code for code, line in enumerate(self.lines)}
+
+def load_schedule(path_to_schedule: str) -> CompactSchedule:
+    '''
+    Load the compact schedule for the csv file.
+
+    The compact schedule is saved next to the csv file and rebuilt when the csv file changes.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    '''
+    return load_derived(os.path.splitext(path_to_schedule)[0] + '.trips.pkl', [path_to_schedule],
+                        lambda: CompactSchedule.from_csv(path_to_schedule))
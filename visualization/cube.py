@@ -0,0 +1,449 @@
+''' Persistent pre-aggregated store of delays and overspeeding with roll-up queries.
+
+Every table of the cube is a cuboid, i.e. the cells of one set of dimensions.
+The finest cuboids keep every dimension, the coarser ones are derived
+from them and answer the common roll-ups without reading the finest cells.
+A query reads the smallest cuboid that has all the dimensions it needs.
+
+The cube is a directory with one parquet file per table and day, with row
+groups of single hours. A query reads only the files of the selected days
+and only the columns and hours it needs.
+'''
+import datetime
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from .overspeed import Street, count_overspeeding_vehicles_from_hour
+from .punctuality import MAX_DELAY, get_delays_from_hour
+
+PATH_TO_CUBE = 'data/cube'
+
+# one minute wide delay bins serve as a mergeable quantile sketch
+DELAY_DIMENSIONS = ['Day', 'Hour', 'Line', 'Brigade', 'BusstopID', 'BusstopNr', 'Bin']
+DELAY_BINS = int(np.ceil(MAX_DELAY))
+DELAY_MEASURES = ['Count', 'DelaySum', 'DelaySquaresSum']
+OVERSPEED_DIMENSIONS = ['Day', 'Hour', 'Street', 'District', 'City']
+OVERSPEED_MEASURES = ['Vehicles']
+# the other dimensions are text
+DIMENSION_TYPES = {'Day': pa.timestamp('ns'), 'Hour': pa.int8(), 'Bin': pa.int8(),
+                   'Brigade': pa.int16(), 'BusstopID': pa.int32(), 'BusstopNr': pa.int16()}
+TABLES = {
+    # a brigade rarely visits a stop twice within an hour,
+    # so there is about one cell per delay
+    'delays': (DELAY_DIMENSIONS, DELAY_MEASURES),
+    # several times fewer cells, for roll-ups by lines, days and hours
+    'line_delays': (['Day', 'Hour', 'Line', 'Bin'], DELAY_MEASURES),
+    # the delays of a vehicle change slowly, so its visits in an hour share a few bins
+    'brigade_delays': (['Day', 'Hour', 'Line', 'Brigade', 'Bin'], DELAY_MEASURES),
+    # several times fewer cells, for roll-ups by stops of whole days
+    'daily_stop_delays': (['Day', 'BusstopID', 'BusstopNr', 'Bin'], DELAY_MEASURES),
+    'overspeeding': (OVERSPEED_DIMENSIONS, OVERSPEED_MEASURES),
+    # vehicles overspeeding in the hour, each counted once whatever the streets
+    'overspeeding_totals': (['Day', 'Hour'], OVERSPEED_MEASURES),
+}
+# tables derived from the cells of a finer table of the same day
+DERIVED = {'line_delays': 'delays', 'brigade_delays': 'delays', 'daily_stop_delays': 'delays'}
+# cuboids of each kind of data, from the smallest
+CUBOIDS = {
+    'delays': ['line_delays', 'brigade_delays', 'daily_stop_delays', 'delays'],
+    'overspeeding': ['overspeeding_totals', 'overspeeding'],
+}
+
+def histogram_quantile(histograms: np.ndarray, q: float) -> np.ndarray:
+    '''
+    Estimate the quantile of delays from one minute wide histograms.
+
+    :param histograms: Array with one histogram per row.
+
+    :param q: Quantile to estimate, between 0 and 1.
+
+    '''
+    histograms = np.asarray(histograms, dtype=float)
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1]
+    target = q * totals
+    bins = np.minimum((cumulative < target[:, None]).sum(axis=1), histograms.shape[1] - 1)
+    rows = np.arange(len(histograms))
+    below = np.where(bins > 0, cumulative[rows, bins - 1], 0)
+    in_bin = histograms[rows, bins]
+    fraction = np.divide(target - below, in_bin, out=np.zeros_like(target), where=in_bin > 0)
+    return np.where(totals > 0, bins + fraction, np.nan)
+
+class AnalysisCube:
+    '''
+    Counts, delay sums and delay sums of squares bucketed by day, hour, line, brigade,
+    stop and one minute wide delay bin, and the number of overspeeding vehicles
+    bucketed by day and hour, in total and on each street.
+    '''
+    def __init__(self, path: str = PATH_TO_CUBE):
+        self.path = path
+        # cells of the days changed since the cube was loaded or saved, with all their hours,
+        # the cells of the derived tables are derived from them when needed
+        self.changed: Dict[Tuple[str, pd.Timestamp], pd.DataFrame] = {}
+
+    @property
+    def delays(self) -> pd.DataFrame:
+        ''' All the delay cells. '''
+        return self.table('delays')
+
+    @property
+    def overspeeding(self) -> pd.DataFrame:
+        ''' All the overspeeding cells. '''
+        return self.table('overspeeding')
+
+    def table(self, name: str) -> pd.DataFrame:
+        '''
+        Get the cells of all the days and hours of the table.
+
+        :param name: Name of the table, from TABLES.
+
+        '''
+        dimensions, measures = TABLES[name]
+        return self.read(name, dimensions + measures)
+
+    def days(self, name: str) -> Set[pd.Timestamp]:
+        '''
+        Get the days of the table which have cells.
+
+        :param name: Name of the table, from TABLES.
+
+        '''
+        days = set()
+        if os.path.exists(self.path):
+            for file_name in os.listdir(self.path):
+                table, _, day = file_name[:-len('.parquet')].partition('--')
+                if table == name and file_name.endswith('.parquet'):
+                    days.add(pd.Timestamp(day))
+        for table, day in self.changed:
+            if table == DERIVED.get(name, name):
+                days.add(day)
+        return days
+
+    def read(self, name: str, columns: List[str],
+             filters: Optional[Dict[str, Iterable]] = None,
+             hours: Optional[Iterable[int]] = None,
+             weekdays: Optional[Iterable[int]] = None,
+             since: Optional[datetime.date] = None,
+             until: Optional[datetime.date] = None) -> pd.DataFrame:
+        '''
+        Read the given columns of the cells from the selected days and hours.
+
+        Only the files of the selected days are opened, and only the given columns
+        of the row groups which may hold the selected cells are read from them.
+        'Weekday' can be requested as a column.
+
+        :param name: Name of the table, from TABLES.
+
+        :param columns: Columns to read.
+
+        :param filters: If given, only cells with these values of the dimensions are read.
+
+        :param hours: If given, only these hours are read.
+
+        :param weekdays: If given, only days of the week are read (0 is Monday).
+
+        :param since: If given, only cells from this day on are read.
+
+        :param until: If given, only cells up to this day are read.
+
+        '''
+        return self._scan(name, columns, filters, hours, weekdays, since, until).to_pandas()
+
+    def aggregate(self, name: str, by: List[str],
+                  filters: Optional[Dict[str, Iterable]] = None,
+                  hours: Optional[Iterable[int]] = None,
+                  weekdays: Optional[Iterable[int]] = None,
+                  since: Optional[datetime.date] = None,
+                  until: Optional[datetime.date] = None) -> pd.DataFrame:
+        '''
+        Sum the measures of the cells from the selected days and hours
+        grouped by the given dimensions.
+
+        The cells are grouped before they are converted to a DataFrame,
+        the parameters are the same as for read.
+
+        '''
+        measures = TABLES[name][1]
+        table = self._scan(name, by + measures, filters, hours, weekdays, since, until)
+        table = table.group_by(by).aggregate([(measure, 'sum') for measure in measures])
+        cells = table.to_pandas().rename(columns={f'{measure}_sum': measure
+                                                  for measure in measures})
+        cells[measures] = cells[measures].fillna(0)
+        return cells[by + measures]
+
+    def _scan(self, name: str, columns: List[str],
+              filters: Optional[Dict[str, Iterable]],
+              hours: Optional[Iterable[int]],
+              weekdays: Optional[Iterable[int]],
+              since: Optional[datetime.date],
+              until: Optional[datetime.date]) -> pa.Table:
+        ''' Read the given columns of the selected cells as an arrow table, see read. '''
+        filters = {column: list(values) for column, values in (filters or {}).items()}
+        if hours is not None:
+            filters['Hour'] = list(hours)
+        expression = None
+        for column, values in filters.items():
+            condition = ds.field(column).isin(values)
+            expression = condition if expression is None else expression & condition
+        weekdays = None if weekdays is None else set(weekdays)
+        days = [day for day in sorted(self.days(name))
+                if (since is None or day >= pd.Timestamp(since))
+                and (until is None or day <= pd.Timestamp(until))
+                and (weekdays is None or day.weekday() in weekdays)]
+        read_columns = [column for column in columns if column != 'Weekday']
+        if 'Weekday' in columns and 'Day' not in read_columns:
+            read_columns.append('Day')
+
+        base = DERIVED.get(name, name)
+        tables = []
+        paths = [self._day_path(name, day) for day in days if (base, day) not in self.changed]
+        if paths:
+            # row groups of other hours are skipped by their statistics
+            tables.append(ds.dataset(paths, format='parquet')
+                          .to_table(columns=read_columns, filter=expression))
+        schema = _schema(*TABLES[name])
+        for day in days:
+            if (base, day) in self.changed:
+                table = pa.Table.from_pandas(self._changed_cells(name, day), schema=schema,
+                                             preserve_index=False)
+                if expression is not None:
+                    table = table.filter(expression)
+                tables.append(table.select(read_columns))
+        table = pa.concat_tables(tables) if tables \
+                else schema.empty_table().select(read_columns)
+        if 'Weekday' in columns:
+            table = table.append_column('Weekday', pc.day_of_week(table['Day']))
+        return table.select(columns)
+
+    def set_hour(self, name: str, day: pd.Timestamp, hour: int, cells: pd.DataFrame):
+        '''
+        Replace the cells of the table from the given hour.
+
+        :param name: Name of the table, from TABLES.
+
+        :param day: Day of the data.
+
+        :param hour: Hour of the day.
+
+        :param cells: New cells of the hour.
+
+        '''
+        dimensions, measures = TABLES[name]
+        if (name, day) not in self.changed:
+            path = self._day_path(name, day)
+            self.changed[(name, day)] = pq.read_table(path).to_pandas() \
+                                        if os.path.exists(path) else _empty(dimensions, measures)
+        other_hours = self.changed[(name, day)]
+        other_hours = other_hours[other_hours['Hour'] != hour]
+        cells = cells.assign(Day=day, Hour=np.int8(hour))[dimensions + measures]
+        # cells sorted by hour, each hour is saved as one row group
+        self.changed[(name, day)] = pd.concat([other_hours, cells], ignore_index=True) \
+                                      .astype(_empty(dimensions, measures).dtypes.to_dict()) \
+                                      .sort_values('Hour', kind='stable', ignore_index=True)
+
+    def save(self):
+        ''' Save the days changed since the cube was loaded or saved. '''
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for base, day in sorted(self.changed):
+            for name in [base] + [name for name in DERIVED if DERIVED[name] == base]:
+                self._write(name, day, self._changed_cells(name, day))
+        self.changed.clear()
+
+    def _changed_cells(self, name: str, day: pd.Timestamp) -> pd.DataFrame:
+        ''' Get the cells of the table from the changed day, deriving them if needed. '''
+        cells = self.changed[(DERIVED.get(name, name), day)]
+        if name in DERIVED:
+            cells = _group(cells, *TABLES[name])
+        return cells
+
+    def _write(self, name: str, day: pd.Timestamp, cells: pd.DataFrame):
+        ''' Save the cells of the table from the given day. '''
+        table = pa.Table.from_pandas(cells, schema=_schema(*TABLES[name]), preserve_index=False)
+        path = self._day_path(name, day)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        # row groups of single hours, skipped by queries of other hours
+        with pq.ParquetWriter(tmp_path, table.schema) as writer:
+            hours = cells['Hour'].values if 'Hour' in cells else np.zeros(len(cells))
+            starts = np.flatnonzero(np.diff(hours, prepend=-1))
+            for start, end in zip(starts, np.append(starts[1:], len(cells))):
+                writer.write_table(table.slice(start, end - start))
+        os.replace(tmp_path, path)
+
+    def add_delays(self, delays: pd.DataFrame, day: datetime.date, hour: int):
+        '''
+        Aggregate delays from one processed hour, replacing the hour if it was added before.
+
+        :param delays: DataFrame with delays, as returned by get_delays.
+
+        :param day: Day of the data.
+
+        :param hour: Hour of the day.
+
+        '''
+        day = pd.Timestamp(day)
+        cells = pd.DataFrame({
+            'Line': delays['Line'].astype(str).values,
+            'Brigade': delays['Brigade'].astype(np.int16).values,
+            'BusstopID': delays['BusstopID'].astype(np.int32).values,
+            'BusstopNr': delays['BusstopNr'].astype(np.int16).values,
+            'Bin': np.clip(np.floor(delays['Delay'].values), 0, DELAY_BINS - 1).astype(np.int8),
+            'Count': np.ones(len(delays), dtype=np.int32),
+            'DelaySum': delays['Delay'].values.astype(float),
+            'DelaySquaresSum': delays['Delay'].values.astype(float) ** 2,
+        })
+        self.set_hour('delays', day, hour, _group(cells, DELAY_DIMENSIONS[2:], DELAY_MEASURES))
+
+    def add_overspeeding(self, vehicles: int, streets: Dict[Street, Set[str]],
+                         day: datetime.date, hour: int):
+        '''
+        Aggregate overspeeding vehicles from one processed hour,
+        replacing the hour if it was added before.
+
+        :param vehicles: Number of overspeeding vehicles,
+                         as returned by count_overspeeding_vehicles.
+
+        :param streets: Overspeeding vehicles on each street,
+                        as returned by count_overspeeding_vehicles.
+
+        :param day: Day of the data.
+
+        :param hour: Hour of the day.
+
+        '''
+        day = pd.Timestamp(day)
+        cells = pd.DataFrame([{'Street': street.name, 'District': street.district,
+                               'City': street.city, 'Vehicles': len(street_vehicles)}
+                              for street, street_vehicles in streets.items()],
+                             columns=['Street', 'District', 'City', 'Vehicles'])
+        self.set_hour('overspeeding', day, hour, cells)
+        self.set_hour('overspeeding_totals', day, hour, pd.DataFrame({'Vehicles': [vehicles]}))
+
+    def add_hour(self, day: datetime.date, hour: int):
+        '''
+        Process the data from the given hour and add it to the cube.
+
+        :param day: Day of the data.
+
+        :param hour: Hour of the day.
+
+        '''
+        self.add_delays(get_delays_from_hour(hour), day, hour)
+        self.add_overspeeding(*count_overspeeding_vehicles_from_hour(hour), day, hour)
+
+    def rollup_delays(self, by: List[str],
+                      lines: Optional[Iterable[str]] = None,
+                      hours: Optional[Iterable[int]] = None,
+                      weekdays: Optional[Iterable[int]] = None,
+                      since: Optional[datetime.date] = None,
+                      until: Optional[datetime.date] = None) -> pd.DataFrame:
+        '''
+        Roll delays up to the given dimensions.
+
+        Returns the number of stops, mean and standard deviation of delays and
+        the median and 90th percentile estimated from the delay bins.
+
+        :param by: Dimensions to keep, from DELAY_DIMENSIONS without 'Bin', and 'Weekday'.
+
+        :param lines: If given, only these lines are taken into account.
+
+        :param hours: If given, only these hours are taken into account.
+
+        :param weekdays: If given, only these days of the week are taken into account
+                         (0 is Monday).
+
+        :param since: If given, only data from this day on is taken into account.
+
+        :param until: If given, only data up to this day is taken into account.
+
+        '''
+        filters = {} if lines is None else {'Line': [str(line) for line in lines]}
+        name = _cuboid('delays', by + list(filters) + ([] if hours is None else ['Hour']))
+        bins = self.aggregate(name, by + ['Bin'], filters, hours, weekdays, since, until)
+        # the bins are summed by the numbers of their groups, which follow the sorted dimensions
+        if by:
+            ids = bins.groupby(by).ngroup().values
+            groups = int(ids.max()) + 1 if len(ids) else 0
+            first = np.zeros(groups, dtype=np.int64)
+            first[ids[::-1]] = np.arange(len(ids))[::-1]
+            result = bins[by].iloc[first].reset_index(drop=True)
+        else:
+            ids = np.zeros(len(bins), dtype=np.int64)
+            groups = 1
+            result = pd.DataFrame(index=range(groups))
+        for measure in DELAY_MEASURES:
+            result[measure] = np.bincount(ids, bins[measure].values.astype(float), groups)
+        result['Count'] = result['Count'].astype(np.int64)
+        histograms = np.bincount(ids * DELAY_BINS + bins['Bin'].values.astype(np.int64),
+                                 bins['Count'].values.astype(float), groups * DELAY_BINS) \
+                       .reshape(groups, DELAY_BINS)
+
+        count = result['Count'].astype(float)
+        result['MeanDelay'] = result['DelaySum'] / count
+        variance = result['DelaySquaresSum'] / count - result['MeanDelay'] ** 2
+        result['StdDelay'] = np.sqrt(variance.clip(lower=0))
+        result['MedianDelay'] = histogram_quantile(histograms, 0.5)
+        result['P90Delay'] = histogram_quantile(histograms, 0.9)
+        return result[by + ['Count', 'MeanDelay', 'StdDelay', 'MedianDelay', 'P90Delay']]
+
+    def rollup_overspeeding(self, by: List[str],
+                            hours: Optional[Iterable[int]] = None,
+                            weekdays: Optional[Iterable[int]] = None,
+                            since: Optional[datetime.date] = None,
+                            until: Optional[datetime.date] = None) -> pd.DataFrame:
+        '''
+        Roll the numbers of overspeeding vehicles up to the given dimensions.
+
+        A vehicle overspeeding in several hours is counted once per hour.
+        Rolled up by streets, districts or cities, it is also counted once
+        per street it overspeeds on.
+
+        :param by: Dimensions to keep, from OVERSPEED_DIMENSIONS and 'Weekday'.
+
+        :param hours: If given, only these hours are taken into account.
+
+        :param weekdays: If given, only these days of the week are taken into account
+                         (0 is Monday).
+
+        :param since: If given, only data from this day on is taken into account.
+
+        :param until: If given, only data up to this day is taken into account.
+
+        '''
+        name = _cuboid('overspeeding', by + ([] if hours is None else ['Hour']))
+        result = self.aggregate(name, by, None, hours, weekdays, since, until)
+        return result.sort_values('Vehicles', ascending=False, ignore_index=True)
+
+    def _day_path(self, name: str, day: pd.Timestamp) -> str:
+        ''' Get the path to the file with the cells of the table from the given day. '''
+        return os.path.join(self.path, f'{name}--{day:%Y-%m-%d}.parquet')
+
+def _cuboid(kind: str, dimensions: List[str]) -> str:
+    ''' Get the smallest table of the kind of data with all the given dimensions. '''
+    dimensions = {'Day' if dimension == 'Weekday' else dimension for dimension in dimensions}
+    for name in CUBOIDS[kind]:
+        if dimensions <= set(TABLES[name][0]):
+            return name
+    raise ValueError(f'Unknown dimensions: {sorted(dimensions - set(TABLES[kind][0]))}')
+
+def _schema(dimensions: List[str], measures: List[str]) -> pa.Schema:
+    ''' Get the schema of the saved cells. '''
+    return pa.schema([(dimension, DIMENSION_TYPES.get(dimension, pa.string()))
+                      for dimension in dimensions]
+                     + [(measure, pa.float64() if 'Delay' in measure else pa.int32())
+                        for measure in measures])
+
+def _empty(dimensions: List[str], measures: List[str]) -> pd.DataFrame:
+    ''' Make an empty table of cells. '''
+    return _schema(dimensions, measures).empty_table().to_pandas()
+
+def _group(cells: pd.DataFrame, by: List[str], measures: List[str]) -> pd.DataFrame:
+    ''' Sum the measures of the cells grouped by the given dimensions. '''
+    if not by:
+        return cells[measures].sum().to_frame().T.astype(cells[measures].dtypes.to_dict())
+    return cells.groupby(by, as_index=False, observed=True)[measures].sum()
@@ -0,0 +1,245 @@
+''' Bus stops of every line, precomputed from the schedule and indexed by location. '''
+import json
+import os
+from typing import Dict, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+from .cache import load_derived
+from .compact_schedule import load_schedule
+from .utils import EARTH_RADIUS, WARSAW_CENTER
+
+CELL_SIZE = 100 # meters
+# directory with the bus stop snapshots of fetch_schedules.py, next to the bus stops file
+SNAPSHOTS_DIR_NAME = 'bus_stops_snapshots'
+
+def project(lat: np.ndarray, lon: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Project coordinates to meters east and north of the center of Warsaw.
+
+    :param lat: Latitudes.
+
+    :param lon: Longitudes.
+
+    '''
+    lat0, lon0 = np.radians(WARSAW_CENTER)
+    x = EARTH_RADIUS * 1000 * (np.radians(lon) - lon0) * np.cos(lat0)
+    y = EARTH_RADIUS * 1000 * (np.radians(lat) - lat0)
+    return x, y
+
+def snapshots_state(path_to_bus_stops: str) -> Optional[Dict]:
+    '''
+    Get the versions of the bus stop snapshots the bus stops file and the schedule
+    are up to date with, None if there are no snapshots.
+
+    The state also holds the time of the last crawl of the whole schedule.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    '''
+    snapshots_dir = os.path.join(os.path.dirname(path_to_bus_stops), SNAPSHOTS_DIR_NAME)
+    try:
+        versions = [int(name[len('snapshot-'):-len('.json')])
+                    for name in os.listdir(snapshots_dir)
+                    if name.startswith('snapshot-') and name.endswith('.json')]
+        with open(os.path.join(snapshots_dir, 'schedule.json'), 'r', encoding='utf-8') as f:
+            schedule = json.load(f)
+        return {'stops': max(versions), 'schedule': schedule['version'],
+                'crawled': schedule.get('crawled')}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def affected_stops(path_to_bus_stops: str, old: Optional[Dict],
+                   new: Optional[Dict]) -> Optional[Set[Tuple[int, int]]]:
+    '''
+    Get the bus stops (ID and number) changed between two states of the snapshots.
+
+    Only these stops differ in the bus stops file and the schedule between the states.
+    Returns None if that is not known, e.g. the schedule was crawled again
+    or a diff is missing, so whatever depends on them must be rebuilt.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param old: State of the snapshots, as returned by snapshots_state.
+
+    :param new: Later state of the snapshots.
+
+    '''
+    if old is None or new is None or old['crawled'] != new['crawled'] \
+       or new['stops'] < old['stops'] or new['schedule'] < old['schedule'] or old == new:
+        return None
+    snapshots_dir = os.path.join(os.path.dirname(path_to_bus_stops), SNAPSHOTS_DIR_NAME)
+    affected = set()
+    for version in range(old['schedule'] + 1, max(new['stops'], new['schedule']) + 1):
+        try:
+            with open(os.path.join(snapshots_dir, f'diff-{version}.json'), 'r',
+                      encoding='utf-8') as f:
+                diff = json.load(f)
+            for kind in ['added', 'removed', 'moved', 'changed']:
+                affected.update((int(bus_stop['BusstopID']), int(bus_stop['BusstopNr']))
+                                for bus_stop in diff[kind])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+    return affected
+
+def stop_keys(stops: pd.DataFrame) -> pd.MultiIndex:
+    '''
+    Get the (BusstopID, BusstopNr) keys of the bus stops as integers.
+
+    :param stops: DataFrame with BusstopID and BusstopNr columns.
+
+    '''
+    return pd.MultiIndex.from_arrays([stops['BusstopID'].astype(np.int64),
+                                      stops['BusstopNr'].astype(np.int64)])
+
+class LineStops:
+    '''
+    Bus stops of every line with their coordinates in meters,
+    and a grid of CELL_SIZE meter cells with the stops of every line.
+    '''
+    def __init__(self, path_to_bus_stops: str, path_to_schedule: str):
+        '''
+        Build the bus stops of the lines.
+
+        :param path_to_bus_stops: Path to the file with all bus stops.
+
+        :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+        '''
+        # state of the snapshots the lines were built from, see update
+        self.state = snapshots_state(path_to_bus_stops)
+        line_stops = self._locate(load_schedule(path_to_schedule).line_stops(),
+                                  pd.read_json(path_to_bus_stops))
+        self.columns = [column for column in line_stops.columns if column != 'Line']
+        self.stops: Dict[str, pd.DataFrame] = {}
+        self.grids: Dict[str, Dict[Tuple[int, int], np.ndarray]] = {}
+        self._add_lines(line_stops)
+
+    @staticmethod
+    def _locate(line_stops: pd.DataFrame, bus_stops: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Add the coordinates of the bus stops to the pairs of line and bus stop.
+
+        :param line_stops: Pairs of line and bus stop.
+
+        :param bus_stops: All bus stops.
+
+        '''
+        line_stops = pd.merge(line_stops, bus_stops, on=['BusstopID', 'BusstopNr'], how='left')
+        line_stops['LatRound'] = line_stops['Latitude'].round(4)
+        line_stops['LonRound'] = line_stops['Longitude'].round(4)
+        line_stops['X'], line_stops['Y'] = project(line_stops['Latitude'].values,
+                                                   line_stops['Longitude'].values)
+        return line_stops
+
+    def _add_lines(self, line_stops: pd.DataFrame):
+        '''
+        Add the bus stops of the lines and their grids.
+
+        :param line_stops: Located pairs of line and bus stop, as returned by _locate.
+
+        '''
+        for line, stops in line_stops.groupby('Line', sort=False):
+            stops = stops.drop(columns=['Line']).reset_index(drop=True)
+            self.stops[line] = stops
+            located = stops.dropna(subset=['X', 'Y'])
+            cells = pd.Series(located.index.values,
+                              index=pd.MultiIndex.from_arrays(
+                                  [np.floor(located['X'] / CELL_SIZE).astype(int),
+                                   np.floor(located['Y'] / CELL_SIZE).astype(int)]))
+            self.grids[line] = {cell: positions.values for cell, positions
+                                in cells.groupby(level=[0, 1])}
+
+    def update(self, path_to_bus_stops: str, path_to_schedule: str,
+               affected: Set[Tuple[int, int]], state: Optional[Dict] = None):
+        '''
+        Rebuild only the lines which used or use any of the affected bus stops.
+
+        The other lines are kept as they are, so the files must differ
+        from the ones the lines were built from only at the affected stops.
+
+        :param path_to_bus_stops: Path to the file with all bus stops.
+
+        :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+        :param affected: Changed bus stops (ID and number), as returned by affected_stops.
+
+        :param state: State of the snapshots the files are up to date with.
+
+        '''
+        pairs = load_schedule(path_to_schedule).line_stops()
+        affected = list(affected)
+        lines = set(pairs['Line'][stop_keys(pairs).isin(affected)])
+        lines |= set(pairs['Line']).symmetric_difference(self.stops)
+        lines |= {line for line, stops in self.stops.items()
+                  if stop_keys(stops).isin(affected).any()}
+        for line in lines:
+            self.stops.pop(line, None)
+            self.grids.pop(line, None)
+        pairs = pairs[pairs['Line'].isin(lines)]
+        if not pairs.empty:
+            self._add_lines(self._locate(pairs, pd.read_json(path_to_bus_stops)))
+        self.state = state
+
+    def line_bus_stops(self, line: str) -> pd.DataFrame:
+        '''
+        Get all the bus stops for the given line. The result is shared and must not be modified.
+
+        :param line: Bus line number.
+
+        '''
+        if line not in self.stops:
+            return pd.DataFrame(columns=self.columns)
+        return self.stops[line]
+
+    def stops_near(self, line: str, lat: float, lon: float, radius: float) -> pd.DataFrame:
+        '''
+        Get the bus stops of the line within the radius from the location,
+        with their distance in meters.
+
+        :param line: Bus line number.
+
+        :param lat: Latitude.
+
+        :param lon: Longitude.
+
+        :param radius: Radius in meters.
+
+        '''
+        stops = self.line_bus_stops(line)
+        grid = self.grids.get(line, {})
+        x, y = project(lat, lon)
+        reach = int(np.ceil(radius / CELL_SIZE))
+        cell_x, cell_y = int(np.floor(x / CELL_SIZE)), int(np.floor(y / CELL_SIZE))
+        positions = [grid[(i, j)] for i in range(cell_x - reach, cell_x + reach + 1)
+                     for j in range(cell_y - reach, cell_y + reach + 1) if (i, j) in grid]
+        if not positions:
+            return stops.iloc[:0].assign(Distance=pd.Series(dtype=float))
+        near = stops.iloc[np.concatenate(positions)]
+        distances = np.hypot(near['X'].values - x, near['Y'].values - y)
+        near = near.assign(Distance=distances)
+        return near[near['Distance'] <= radius].sort_values('Distance')
+
+def load_line_stops(path_to_bus_stops: str, path_to_schedule: str) -> LineStops:
+    '''
+    Load the bus stops of the lines.
+
+    They are saved next to the schedule and rebuilt when the schedule or the bus stops change.
+    When they changed only by the diffs of the bus stop snapshots,
+    only the lines using the changed stops are rebuilt.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    '''
+    def update(line_stops: LineStops) -> Optional[LineStops]:
+        state = snapshots_state(path_to_bus_stops)
+        affected = affected_stops(path_to_bus_stops, getattr(line_stops, 'state', None), state)
+        if affected is None:
+            return None
+        line_stops.update(path_to_bus_stops, path_to_schedule, affected, state)
+        return line_stops
+
+    return load_derived(os.path.splitext(path_to_schedule)[0] + '.line-stops.pkl',
+                        [path_to_bus_stops, path_to_schedule],
+                        lambda: LineStops(path_to_bus_stops, path_to_schedule), update)
@@ -7,6 +7,10 @@ import folium
 from tqdm import tqdm
 from .utils import calculate_distance, get_address_components
 from .utils import WARSAW_CENTER, date_to_seconds
+from .cache import cached_call
+from .cleaning import clean_localizations
+
+SPEED_LIMIT = 50 # km/h
 
 class Street:
     ''' Class representing a street. '''
@@ -60,9 +64,9 @@ def calculate_speeds(group: pd.DataFrame) -> pd.DataFrame:
     group['PrevTime'] = group['Time'].shift(1)
 
     # fill first rows with actual values
-    group['PrevLon'].fillna(group['Lon'].iloc[0], inplace=True)
-    group['PrevLat'].fillna(group['Lat'].iloc[0], inplace=True)
-    group['PrevTime'].fillna(group['Time'].iloc[0], inplace=True)
+    group['PrevLon'] = group['PrevLon'].fillna(group['Lon'].iloc[0])
+    group['PrevLat'] = group['PrevLat'].fillna(group['Lat'].iloc[0])
+    group['PrevTime'] = group['PrevTime'].fillna(group['Time'].iloc[0])
 
     group['Speed'] = group.apply(lambda row: calculate_speed((row['PrevLat'], row['PrevLon']),
                                                                 (row['Lat'], row['Lon']),
@@ -81,22 +85,25 @@ def get_street(lat: float, lon: float) -> Street:
     '''
     return Street(*get_address_components(lat, lon))
 
-def count_overspeeding_vehicles(path_to_localizations: str, save_map: bool) \
-                                -> Tuple[int, Dict[str, int]]:
+def find_overspeeding_vehicles(localizations: pd.DataFrame, save_map: bool,
+                               speed_limit: float = SPEED_LIMIT) \
+                               -> Tuple[Set[str], Dict[Street, Set[str]], Dict[str, int]]:
     '''
-    Count overspeeding vehicles and their number on each street.
-    
-    :param path_to_localizations: Path to the file with bus localizations.
-    
+    Find overspeeding vehicles and the vehicles overspeeding on each street.
+
+    Also returns the numbers of samples removed by clean_localizations.
+
+    :param localizations: DataFrame with bus localizations.
+
     :param save_map: If True, save the map with overspeeding vehicles.
-    
+
+    :param speed_limit: Speed in km/h above which the vehicle is overspeeding.
+
     '''
-    result: Dict[str, Set[str]] = {}
+    result: Dict[Street, Set[str]] = {}
     overspeeding_vehicles: Set[str] = set()
 
-    with open(path_to_localizations, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    localizations = pd.DataFrame(data)
+    localizations, report = clean_localizations(localizations)
 
     if save_map:
         m = folium.Map(location=WARSAW_CENTER, zoom_start=12)
@@ -108,7 +115,7 @@ def count_overspeeding_vehicles(path_to_localizations: str, save_map: bool) \
         group = group.drop_duplicates('Time')
         group = calculate_speeds(group)
         for i in range(1, len(group)):
-            if group['Speed'].iloc[i] > 50:
+            if group['Speed'].iloc[i] > speed_limit:
                 overspeeding_vehicles.add(vehicle)
                 street = get_street(group['Lat'].iloc[i], group['Lon'].iloc[i])
                 if street not in result and street.name != '':
@@ -127,13 +134,53 @@ def count_overspeeding_vehicles(path_to_localizations: str, save_map: bool) \
             os.makedirs('maps')
         m.save('maps/overspeed_map.html')
 
+    return overspeeding_vehicles, result, report
+
+def count_overspeeding_vehicles(path_to_localizations: str, save_map: bool,
+                                speed_limit: float = SPEED_LIMIT, with_report: bool = False) \
+                                -> Tuple[int, Dict[str, int]]:
+    '''
+    Count overspeeding vehicles and their number on each street.
+
+    If with_report is True, the numbers of samples removed by the cleaning
+    of localizations are returned as the third element, see format_report.
+    
+    :param path_to_localizations: Path to the file with bus localizations.
+    
+    :param save_map: If True, save the map with overspeeding vehicles.
+
+    :param speed_limit: Speed in km/h above which the vehicle is overspeeding.
+
+    :param with_report: If True, also return the numbers of removed samples.
+    
+    '''
+    with open(path_to_localizations, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    localizations = pd.DataFrame(data)
+
+    overspeeding_vehicles, result, report = find_overspeeding_vehicles(localizations, save_map,
+                                                                       speed_limit)
+    if with_report:
+        return len(overspeeding_vehicles), result, report
     return len(overspeeding_vehicles), result
 
-def count_overspeeding_vehicles_from_hour(hour: int) -> Tuple[int, Dict[str, int]]:
+def count_overspeeding_vehicles_from_hour(hour: int, use_cache: bool = True,
+                                          with_report: bool = False) \
+                                          -> Tuple[int, Dict[str, int]]:
     '''
     Count overspeeding vehicles from the given hour.
     
     :param hour: Hour of the day.
 
+    :param use_cache: If True, reuse the result computed earlier for the same data.
+                      Pass False when profiling, a reused result skips the analysis.
+
+    :param with_report: If True, also return the numbers of samples removed by the cleaning.
+
     '''
-    return count_overspeeding_vehicles(f'data/buses-{hour}.json', False)
+    path = f'data/buses-{hour}.json'
+    if not use_cache:
+        return count_overspeeding_vehicles(path, False, with_report=with_report)
+    return cached_call(count_overspeeding_vehicles, [path],
+                       {'save_map': False, 'speed_limit': SPEED_LIMIT,
+                        'with_report': with_report})
@@ -1,12 +1,20 @@
 ''' Module for calculating the punctuality of the buses. '''
 from datetime import datetime
+import json
+from multiprocessing import Pool
+from typing import Dict, List, Optional
 import pandas as pd
 from tqdm import tqdm
+from .arrivals import build_events, build_events_from_hour, get_delays_from_events, \
+                      get_delays_from_events_file, get_stops_of_lines
+from .cache import cached_call
+from .compact_schedule import load_schedule
+from .line_stops import load_line_stops
+from .shared_tables import SHARED_DIR, publish_schedule_tables, table_rows
+from .utils import MAX_DELAY, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE
 
-PATH_TO_BUS_STOPS = 'data/bus_stops.json'
-PATH_TO_SCHEDULE = 'data/schedule.csv'
-
-def get_line_schedule(line: str, path_to_schedule: str) -> pd.DataFrame:
+def get_line_schedule(line: str, path_to_schedule: str,
+                      tables: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     '''
     Get the schedule for the given line.
 
@@ -14,12 +22,19 @@ def get_line_schedule(line: str, path_to_schedule: str) -> pd.DataFrame:
 
     :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
 
+    :param tables: If given, tables returned by publish_schedule_tables are used
+                   instead of the files.
+
     '''
-    schedule = pd.read_csv(path_to_schedule, low_memory=False)
+    if tables is not None:
+        schedule = table_rows(tables['schedule'], line).reset_index(drop=True)
+    else:
+        schedule = load_schedule(path_to_schedule).line_schedule(line)
     schedule['Brigade'] = schedule['Brigade'].astype(int)
-    return schedule[schedule['Line'] == line]
+    return schedule
 
-def get_line_bus_stops(line: str, path_to_bus_stops: str, path_to_schedule: str) -> pd.DataFrame:
+def get_line_bus_stops(line: str, path_to_bus_stops: str, path_to_schedule: str,
+                       tables: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     '''
     Get all the bus stops for the given line.
 
@@ -29,20 +44,19 @@ def get_line_bus_stops(line: str, path_to_bus_stops: str, path_to_schedule: str)
 
     :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
 
-    '''
-    bus_stops = pd.read_json(path_to_bus_stops)
-    line_schedule = get_line_schedule(line, path_to_schedule)
-    line_bus_stops = line_schedule[['BusstopID', 'BusstopNr']].drop_duplicates()
-    line_bus_stops = pd.merge(line_bus_stops, bus_stops, on=['BusstopID', 'BusstopNr'], how='left')
-
-    line_bus_stops['LatRound'] = line_bus_stops['Latitude'].round(4)
-    line_bus_stops['LonRound'] = line_bus_stops['Longitude'].round(4)
+    :param tables: If given, tables returned by publish_schedule_tables are used
+                   instead of the files.
 
-    return line_bus_stops
+    '''
+    if tables is not None:
+        return table_rows(tables['line_stops'], line).drop(columns=['Line']) \
+                   .reset_index(drop=True)
+    return load_line_stops(path_to_bus_stops, path_to_schedule).line_bus_stops(line).copy()
 
 def get_line_stops(line: str, localizations: pd.DataFrame,
                    path_to_bus_stops: str,
-                   path_to_schedule: str) -> pd.DataFrame:
+                   path_to_schedule: str,
+                   tables: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     '''
     For given line and localizations, get all the stops and the time.
     
@@ -52,16 +66,22 @@ def get_line_stops(line: str, localizations: pd.DataFrame,
 
     :param path_to_bus_stops: Path to the file with all bus stops.
 
+    :param tables: If given, tables returned by publish_schedule_tables are used
+                   instead of the files.
+
     '''
     localizations = localizations[localizations['Lines'] == line]
-    bus_stops = get_line_bus_stops(line, path_to_bus_stops, path_to_schedule).drop_duplicates()
+    bus_stops = get_line_bus_stops(line, path_to_bus_stops, path_to_schedule, tables) \
+                    .drop_duplicates()
 
     localizations_to_stops_rounded = pd.merge(localizations, bus_stops,
                                               on=['LatRound', 'LonRound'], how='inner')
 
     return localizations_to_stops_rounded.sort_values(by='Time')
 
-def get_stop_schedule(line: str, line_stops: pd.DataFrame, path_to_schedule: str) -> pd.DataFrame:
+def get_stop_schedule(line: str, line_stops: pd.DataFrame, path_to_schedule: str,
+                      max_delay: float = MAX_DELAY,
+                      tables: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     '''
     For each stop, get the scheduled time and the actual time.
     
@@ -70,9 +90,14 @@ def get_stop_schedule(line: str, line_stops: pd.DataFrame, path_to_schedule: str
     :param line_stops: DataFrame with bus stops.
     
     :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param max_delay: Delays in minutes from this value up are ignored.
+
+    :param tables: If given, tables returned by publish_schedule_tables are used
+                   instead of the files.
     
     '''
-    schedule = get_line_schedule(line, path_to_schedule)
+    schedule = get_line_schedule(line, path_to_schedule, tables)
     schedule = schedule.sort_values(by='Time')
 
     schedule['Time'] = schedule['Time'].apply(lambda x: '00' + x[2:] if int(x[:2]) >= 24 else x)
@@ -97,7 +122,7 @@ def get_stop_schedule(line: str, line_stops: pd.DataFrame, path_to_schedule: str
         scheduled_stop['Delay'] = delay.seconds / 60
         if 'Unnamed: 0' in scheduled_stop: # unnecessary column
             scheduled_stop.drop(['Unnamed: 0'], inplace=True)
-        if scheduled_stop['Delay'] < 30:
+        if scheduled_stop['Delay'] < max_delay:
             # big delays results from the fact that the bus was
             # near the bus stop in different direction
             result.append(scheduled_stop)
@@ -107,20 +132,26 @@ def get_stop_schedule(line: str, line_stops: pd.DataFrame, path_to_schedule: str
                            keep='first', inplace=True)
     return result
 
-def get_delays(path_to_localizations: str,
-               path_to_bus_stops: str,
-               path_to_schedule: str) -> pd.DataFrame:
-    '''Find all the delays for the given hour.
-    
-    :param path_to_localizations: Path to the file with bus localizations.
-    
+def find_delays(localizations: pd.DataFrame,
+                path_to_bus_stops: str,
+                path_to_schedule: str,
+                max_delay: float = MAX_DELAY,
+                tables: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    '''Find all the delays in the given localizations.
+
+    :param localizations: DataFrame with bus localizations.
+
     :param path_to_bus_stops: Path to the file with all bus stops.
-    
+
     :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
-    
-    '''
-    localizations = pd.read_json(path_to_localizations)
 
+    :param max_delay: Delays in minutes from this value up are ignored.
+
+    :param tables: If given, tables returned by publish_schedule_tables are used
+                   instead of the files.
+
+    '''
+    localizations = localizations.copy()
     lines = localizations['Lines'].unique()
 
     localizations['Time'] = localizations['Time'].apply(
@@ -134,21 +165,89 @@ def get_delays(path_to_localizations: str,
 
     delays = []
     for line in tqdm(lines):
-        line_stops = get_line_stops(line, localizations, path_to_bus_stops, path_to_schedule)
-        line_delays = get_stop_schedule(line, line_stops, path_to_schedule)
+        line_stops = get_line_stops(line, localizations, path_to_bus_stops, path_to_schedule,
+                                    tables)
+        line_delays = get_stop_schedule(line, line_stops, path_to_schedule, max_delay, tables)
         delays.append(line_delays)
     delays = pd.concat(delays)
     return delays
 
-def get_delays_from_hour(hour: int) -> pd.DataFrame:
+def get_delays(path_to_localizations: str,
+               path_to_bus_stops: str,
+               path_to_schedule: str,
+               max_delay: float = MAX_DELAY) -> pd.DataFrame:
+    '''Find all the delays for the given hour.
+    
+    :param path_to_localizations: Path to the file with bus localizations.
+    
+    :param path_to_bus_stops: Path to the file with all bus stops.
+    
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param max_delay: Delays in minutes from this value up are ignored.
+    
     '''
-    Get all delays from the given hour.
+    localizations = pd.read_json(path_to_localizations)
+    return find_delays(localizations, path_to_bus_stops, path_to_schedule, max_delay)
+
+def _get_delays_with_tables(path_to_localizations: str, path_to_bus_stops: str,
+                            path_to_schedule: str, max_delay: float,
+                            tables: Dict[str, str]) -> pd.DataFrame:
+    ''' Find the delays in a worker process, using the shared tables. '''
+    localizations = pd.read_json(path_to_localizations)
+    return find_delays(localizations, path_to_bus_stops, path_to_schedule, max_delay, tables)
+
+def get_delays_in_parallel(paths_to_localizations: List[str],
+                           path_to_bus_stops: str,
+                           path_to_schedule: str,
+                           processes: Optional[int] = None,
+                           max_delay: float = MAX_DELAY,
+                           shared_dir: str = SHARED_DIR) -> List[pd.DataFrame]:
+    '''
+    Find the delays in each of the files with localizations, in worker processes.
+
+    The schedule and the bus stops are published once as memory-mapped tables
+    which the workers share instead of loading their own copies.
+
+    :param paths_to_localizations: Paths to the files with bus localizations.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param processes: Number of worker processes, by default the number of CPUs.
+
+    :param max_delay: Delays in minutes from this value up are ignored.
+
+    :param shared_dir: Directory for the shared tables.
+
+    '''
+    tables = publish_schedule_tables(path_to_schedule, path_to_bus_stops, shared_dir)
+    with Pool(processes) as pool:
+        return pool.starmap(_get_delays_with_tables,
+                            [(path, path_to_bus_stops, path_to_schedule, max_delay, tables)
+                             for path in paths_to_localizations])
+
+def get_delays_from_hour(hour: int, use_cache: bool = True) -> pd.DataFrame:
+    '''
+    Get all delays from the given hour, from the stop arrival events built for it.
     
     :param hour: Hour of the day.
+
+    :param use_cache: If True, reuse the events and the result computed earlier
+                      for the same data. Pass False when profiling,
+                      a reused result skips the analysis.
     
     '''
-    path = f'data/buses-{hour}.json'
-    return get_delays(path, PATH_TO_BUS_STOPS, PATH_TO_SCHEDULE)
+    if not use_cache:
+        with open(f'data/buses-{hour}.json', 'r', encoding='utf-8') as f:
+            localizations = pd.DataFrame(json.load(f))
+        events = build_events(localizations, get_stops_of_lines(PATH_TO_BUS_STOPS,
+                                                                PATH_TO_SCHEDULE))
+        return get_delays_from_events(events, PATH_TO_SCHEDULE)
+    return cached_call(get_delays_from_events_file,
+                       [build_events_from_hour(hour), PATH_TO_SCHEDULE],
+                       {'max_delay': MAX_DELAY})
 
 def filter_delays(delays: pd.DataFrame, threshold: int) -> pd.DataFrame:
     '''
@@ -0,0 +1,223 @@
+''' Approximate analyses on vehicles sampled within lines, with confidence intervals. '''
+import json
+from statistics import NormalDist
+from typing import Dict, Tuple
+import numpy as np
+import pandas as pd
+from .overspeed import SPEED_LIMIT, Street, find_overspeeding_vehicles
+from .punctuality import MAX_DELAY, find_delays
+
+BOOTSTRAP_SAMPLES = 200
+
+class Estimate:
+    ''' Class representing an estimated value with its confidence interval. '''
+    def __init__(self, value: float, low: float, high: float):
+        self.value = value
+        self.low = low
+        self.high = high
+
+    def __str__(self) -> str:
+        return f'{self.value:.2f} [{self.low:.2f}, {self.high:.2f}]'
+
+    def __repr__(self) -> str:
+        return f'Estimate({self.value!r}, {self.low!r}, {self.high!r})'
+
+def sample_vehicles(localizations: pd.DataFrame, rate: float, seed: int = 0) -> pd.DataFrame:
+    '''
+    Sample vehicles within strata made by their most frequently reported line.
+
+    Returns all the vehicles with their stratum, stratum size, number of vehicles
+    sampled from the stratum and whether the vehicle was sampled.
+
+    :param localizations: DataFrame with bus localizations.
+
+    :param rate: Fraction of vehicles to sample from each line, at least one is sampled.
+
+    :param seed: Seed of the random generator.
+
+    '''
+    lines = localizations.groupby(['VehicleNumber', 'Lines']).size().reset_index(name='Size')
+    lines = lines.sort_values(['VehicleNumber', 'Size', 'Lines'], ascending=[True, False, True])
+    vehicles = lines.drop_duplicates('VehicleNumber')[['VehicleNumber', 'Lines']] \
+                    .rename(columns={'Lines': 'Stratum'}).reset_index(drop=True)
+
+    rng = np.random.default_rng(seed)
+    vehicles['Random'] = rng.random(len(vehicles))
+    vehicles['StratumSize'] = vehicles.groupby('Stratum')['VehicleNumber'].transform('size')
+    vehicles['Sampled'] = np.minimum(vehicles['StratumSize'],
+                                     np.maximum(1, np.round(rate * vehicles['StratumSize'])))
+    vehicles['Sampled'] = vehicles['Sampled'].astype(int)
+    rank = vehicles.groupby('Stratum')['Random'].rank(method='first')
+    vehicles['InSample'] = rank <= vehicles['Sampled']
+    return vehicles.drop(columns=['Random'])
+
+def stratified_total(values: pd.DataFrame, vehicles: pd.DataFrame,
+                     confidence: float) -> Dict[str, Estimate]:
+    '''
+    Estimate the totals of per vehicle values over all the vehicles.
+
+    :param values: Values of sampled vehicles, one column per estimated total,
+                   indexed by vehicle number.
+
+    :param vehicles: Vehicles, as returned by sample_vehicles.
+
+    :param confidence: Confidence level of the intervals.
+
+    '''
+    sampled = vehicles[vehicles['InSample']].set_index('VehicleNumber')
+    values = values.reindex(sampled.index, fill_value=0).astype(float)
+    strata = values.groupby(sampled['Stratum'])
+    sizes = sampled.groupby('Stratum')[['StratumSize', 'Sampled']].first()
+
+    means = strata.mean()
+    variances = strata.var(ddof=1)
+    # strata with one sampled vehicle borrow the variance of the whole sample
+    variances = variances.fillna(values.var(ddof=1)).fillna(0)
+
+    population = sizes['StratumSize'].values[:, None]
+    sample = sizes['Sampled'].values[:, None]
+    totals = (means.values * population).sum(axis=0)
+    variance = (population ** 2 * (1 - sample / population) * variances.values / sample) \
+               .sum(axis=0)
+    margin = NormalDist().inv_cdf(0.5 + confidence / 2) * np.sqrt(variance)
+    return {column: Estimate(total, max(total - error, 0), total + error)
+            for column, total, error in zip(values.columns, totals, margin)}
+
+def estimate_overspeeding_vehicles(path_to_localizations: str, rate: float,
+                                   seed: int = 0, confidence: float = 0.95,
+                                   speed_limit: float = SPEED_LIMIT) \
+                                   -> Tuple[Estimate, Dict[Street, Estimate]]:
+    '''
+    Estimate the number of overspeeding vehicles and their number on each street
+    from a sample of vehicles of every line.
+
+    :param path_to_localizations: Path to the file with bus localizations.
+
+    :param rate: Fraction of vehicles to sample from each line.
+
+    :param seed: Seed of the random generator.
+
+    :param confidence: Confidence level of the intervals.
+
+    :param speed_limit: Speed in km/h above which the vehicle is overspeeding.
+
+    '''
+    with open(path_to_localizations, 'r', encoding='utf-8') as f:
+        localizations = pd.DataFrame(json.load(f))
+    vehicles = sample_vehicles(localizations, rate, seed)
+    sampled = vehicles.loc[vehicles['InSample'], 'VehicleNumber']
+    localizations = localizations[localizations['VehicleNumber'].isin(sampled)]
+
+    overspeeding_vehicles, streets, _ = find_overspeeding_vehicles(localizations, False,
+                                                                   speed_limit)
+    streets = list(streets.items())
+    values = pd.DataFrame(0, index=sampled.values, columns=range(len(streets) + 1))
+    values.loc[list(overspeeding_vehicles), 0] = 1
+    for i, (_, street_vehicles) in enumerate(streets, start=1):
+        values.loc[list(street_vehicles), i] = 1
+
+    estimates = stratified_total(values, vehicles, confidence)
+    total = estimates.pop(0)
+    estimates = {street: estimates[i] for i, (street, _) in enumerate(streets, start=1)}
+    estimates = dict(sorted(estimates.items(), key=lambda item: item[1].value, reverse=True))
+    return total, estimates
+
+def weighted_quantile(values: np.ndarray, weights: np.ndarray, q: float) -> float:
+    '''
+    Get the quantile of values sorted in ascending order with the given weights.
+
+    :param values: Sorted values.
+
+    :param weights: Weights of the values.
+
+    :param q: Quantile, between 0 and 1.
+
+    '''
+    cumulative = np.cumsum(weights)
+    if len(cumulative) == 0 or cumulative[-1] == 0:
+        return np.nan
+    return values[np.searchsorted(cumulative, q * cumulative[-1])]
+
+def estimate_delays(path_to_localizations: str,
+                    path_to_bus_stops: str,
+                    path_to_schedule: str,
+                    rate: float,
+                    seed: int = 0,
+                    confidence: float = 0.95,
+                    max_delay: float = MAX_DELAY) -> Tuple[pd.DataFrame, Dict[str, Estimate]]:
+    '''
+    Find delays of a sample of vehicles of every line and estimate the number of delays,
+    the mean, median and 90th percentile of delays in minutes.
+
+    Returns the sampled delays with the weight of each one and the estimates,
+    with confidence intervals from a stratified bootstrap over vehicles.
+
+    :param path_to_localizations: Path to the file with bus localizations.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param rate: Fraction of vehicles to sample from each line.
+
+    :param seed: Seed of the random generator.
+
+    :param confidence: Confidence level of the intervals.
+
+    :param max_delay: Delays in minutes from this value up are ignored.
+
+    '''
+    localizations = pd.read_json(path_to_localizations)
+    localizations['VehicleNumber'] = localizations['VehicleNumber'].astype(str)
+    vehicles = sample_vehicles(localizations, rate, seed)
+    sampled = vehicles[vehicles['InSample']].reset_index(drop=True)
+    localizations = localizations[localizations['VehicleNumber'].isin(sampled['VehicleNumber'])]
+
+    delays = find_delays(localizations, path_to_bus_stops, path_to_schedule, max_delay)
+    # delays are reported per line and brigade, which identify the vehicle
+    brigades = localizations[['Lines', 'Brigade', 'VehicleNumber']].drop_duplicates(
+                   ['Lines', 'Brigade']).astype(str)
+    delays = delays.assign(Lines=delays['Line'].astype(str),
+                           BrigadeKey=delays['Brigade'].astype(str))
+    delays = pd.merge(delays, brigades.rename(columns={'Brigade': 'BrigadeKey'}),
+                      on=['Lines', 'BrigadeKey'], how='left') \
+               .drop(columns=['Lines', 'BrigadeKey'])
+    vehicle_index = pd.Series(sampled.index, index=sampled['VehicleNumber'])
+    delays['Weight'] = (sampled['StratumSize'] / sampled['Sampled']) \
+                           .reindex(vehicle_index.reindex(delays['VehicleNumber'])).values
+    delays = delays.dropna(subset=['Weight'])
+
+    order = np.argsort(delays['Delay'].values, kind='stable')
+    values = delays['Delay'].values[order]
+    weights = delays['Weight'].values[order]
+    owners = vehicle_index.reindex(delays['VehicleNumber']).values[order].astype(int)
+
+    def statistics(multiplicity: np.ndarray) -> np.ndarray:
+        replicated = weights * multiplicity[owners]
+        total = replicated.sum()
+        mean = (values * replicated).sum() / total if total > 0 else np.nan
+        return np.array([total, mean,
+                         weighted_quantile(values, replicated, 0.5),
+                         weighted_quantile(values, replicated, 0.9)])
+
+    point = statistics(np.ones(len(sampled)))
+    # resample vehicles with replacement within every stratum
+    sampled = sampled.sort_values('Stratum')
+    positions = sampled.index.values
+    stratum_sizes = sampled.groupby('Stratum', sort=False)['Stratum'].transform('size').values
+    stratum_starts = np.arange(len(sampled)) \
+                     - sampled.groupby('Stratum', sort=False).cumcount().values
+    rng = np.random.default_rng(seed)
+    replicates = []
+    for _ in range(BOOTSTRAP_SAMPLES):
+        draws = stratum_starts + (rng.random(len(sampled)) * stratum_sizes).astype(int)
+        multiplicity = np.bincount(positions[draws], minlength=len(sampled))
+        replicates.append(statistics(multiplicity))
+    replicates = np.array(replicates)
+    tail = (1 - confidence) / 2
+    low = np.nanquantile(replicates, tail, axis=0)
+    high = np.nanquantile(replicates, 1 - tail, axis=0)
+
+    names = ['Count', 'MeanDelay', 'MedianDelay', 'P90Delay']
+    estimates = {name: Estimate(*interval) for name, interval in zip(names, zip(point, low, high))}
+    return delays, estimates
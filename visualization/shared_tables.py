@@ -0,0 +1,181 @@
+''' Tables saved once as memory-mapped files and attached by worker processes without copying. '''
+import json
+import os
+import shutil
+from typing import Dict, Optional, Tuple
+import numpy as np
+import pandas as pd
+from .cache import read_signature, source_signature, write_signature
+from .line_stops import load_line_stops
+
+SHARED_DIR = 'data/shared'
+
+# tables already attached in this process and the row ranges of their keys,
+# keyed by directory and publication signature
+_TABLES: Dict[Tuple[str, int], pd.DataFrame] = {}
+_RANGES: Dict[Tuple[str, int], Dict[str, list]] = {}
+
+def codes_dtype(categories: int) -> np.dtype:
+    '''
+    Get the dtype pandas uses for codes of a categorical with the given number of categories.
+
+    :param categories: Number of categories.
+
+    '''
+    for dtype in (np.int8, np.int16, np.int32):
+        if categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+def publish_table(table: pd.DataFrame, directory: str, key: Optional[str] = None):
+    '''
+    Save the table as one memory-mappable array per column.
+
+    Text columns are saved as integer codes and a dictionary of their values.
+    If the key is given, rows are grouped by it, so the rows of one value
+    can be read with table_rows. Rows with a missing key are kept at the end
+    of the table and are not returned by table_rows.
+
+    :param table: Table to publish.
+
+    :param directory: Directory for the table files.
+
+    :param key: Column by which the rows are looked up.
+
+    '''
+    meta = {'rows': len(table)}
+    if key is not None:
+        codes, values = pd.factorize(table[key])
+        # rows without a key go last, outside of every range
+        codes = np.where(codes < 0, len(values), codes)
+        table = table.iloc[np.argsort(codes, kind='stable')]
+        ends = np.cumsum(np.bincount(codes, minlength=len(values))[:len(values)])
+        meta['key'] = key
+        meta['ranges'] = {str(value): [int(end - count), int(end)] for value, end, count
+                          in zip(values, ends, np.diff(ends, prepend=0))}
+
+    tmp_directory = f'{directory.rstrip(os.sep)}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(tmp_directory)
+
+    columns = []
+    for i, column in enumerate(table.columns):
+        values = table[column]
+        entry = {'name': column, 'file': f'{i}.npy'}
+        if values.dtype.kind in 'biufM':
+            array = values.values
+        else:
+            codes, categories = pd.factorize(values)
+            array = codes.astype(codes_dtype(len(categories)))
+            entry['categories'] = categories.tolist()
+        np.save(os.path.join(tmp_directory, entry['file']), np.ascontiguousarray(array))
+        columns.append(entry)
+    meta['columns'] = columns
+    with open(os.path.join(tmp_directory, 'table.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+
+def attach_table(directory: str) -> pd.DataFrame:
+    '''
+    Attach the published table read-only, sharing its memory with other processes.
+
+    :param directory: Directory with the table files.
+
+    '''
+    path = os.path.join(directory, 'table.json')
+    key = (os.path.abspath(directory), os.stat(path).st_mtime_ns)
+    if key in _TABLES:
+        return _TABLES[key]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    _RANGES[key] = meta.get('ranges', {})
+    columns = {}
+    for entry in meta['columns']:
+        array = np.load(os.path.join(directory, entry['file']), mmap_mode='r')
+        if 'categories' in entry:
+            array = pd.Categorical.from_codes(array, entry['categories'], validate=False)
+        columns[entry['name']] = array
+    table = pd.DataFrame(columns, copy=False)
+    _TABLES[key] = table
+    return table
+
+def table_rows(directory: str, value) -> pd.DataFrame:
+    '''
+    Get a copy of the rows of the published table with the given value of its key.
+
+    Text columns are decoded to their values, so the rows have the same dtypes
+    as the table had when it was published.
+
+    :param directory: Directory with the table files.
+
+    :param value: Value of the key column.
+
+    '''
+    table = attach_table(directory)
+    key = (os.path.abspath(directory),
+           os.stat(os.path.join(directory, 'table.json')).st_mtime_ns)
+    start, stop = _RANGES[key].get(str(value), [0, 0])
+    rows = table.iloc[start:stop]
+    return rows.astype({column: rows[column].cat.categories.dtype for column in rows.columns
+                        if isinstance(rows[column].dtype, pd.CategoricalDtype)})
+
+def read_schedule(path_to_schedule: str) -> pd.DataFrame:
+    '''
+    Read the schedule without the saved index column.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    '''
+    schedule = pd.read_csv(path_to_schedule, low_memory=False)
+    return schedule.drop(columns=['Unnamed: 0'], errors='ignore')
+
+def read_line_stops(path_to_bus_stops: str, path_to_schedule: str) -> pd.DataFrame:
+    '''
+    Read the bus stops of all the lines, as returned by get_line_bus_stops, with their line.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    '''
+    line_stops = load_line_stops(path_to_bus_stops, path_to_schedule)
+    return pd.concat([stops.assign(Line=line) for line, stops in line_stops.stops.items()],
+                     ignore_index=True)
+
+def publish_schedule_tables(path_to_schedule: str, path_to_bus_stops: str,
+                            directory: str = SHARED_DIR) -> Dict[str, str]:
+    '''
+    Publish the schedule, the bus stops and the bus stops of the lines,
+    unless they were published from the same files.
+
+    The schedule and the bus stops of the lines are looked up by line with table_rows.
+    Returns the directories of the tables, to be passed to attach_table
+    or table_rows in worker processes.
+
+    :param path_to_schedule: Path to the file with schedule with all buses and bus stops.
+
+    :param path_to_bus_stops: Path to the file with all bus stops.
+
+    :param directory: Directory for the tables.
+
+    '''
+    sources = {
+        'schedule': ([path_to_schedule], read_schedule, 'Line'),
+        'bus_stops': ([path_to_bus_stops], pd.read_json, None),
+        'line_stops': ([path_to_bus_stops, path_to_schedule], read_line_stops, 'Line'),
+    }
+    result = {}
+    for name, (paths, read, key) in sources.items():
+        table_directory = os.path.join(directory, name)
+        signature = source_signature(paths)
+        path_to_signature = os.path.join(table_directory, 'source.json')
+        if read_signature(path_to_signature) != signature:
+            publish_table(read(*paths), table_directory, key)
+            write_signature(path_to_signature, signature)
+        result[name] = table_directory
+    return result
@@ -2,11 +2,16 @@
 from datetime import datetime
 import os
 from typing import Tuple, List, Dict
+import numpy as np
 from geopy.distance import geodesic
 from geopy.geocoders import Nominatim
 import requests
 
 WARSAW_CENTER = (52.22977, 21.01178)
+EARTH_RADIUS = 6371.0088 # km
+PATH_TO_BUS_STOPS = 'data/bus_stops.json'
+PATH_TO_SCHEDULE = 'data/schedule.csv'
+MAX_DELAY = 30 # minutes
 API_KEY = os.environ.get('WARSAW_DATA_API_KEY')
 URL = f'https://api.um.warszawa.pl/api/action/busestrams_get/?resource_id= \
         f2e5503e-927d-4ad3-9500-4ab9e55deb59&apikey={API_KEY}&type=1'
@@ -22,6 +27,26 @@ def calculate_distance(coord1: tuple[float, float], coord2: tuple[float, float])
     '''
     return geodesic(coord1, coord2).kilometers
 
+def calculate_distances(lat1: np.ndarray, lon1: np.ndarray,
+                        lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    '''
+    Calculate great-circle distances in kilometers between arrays of coordinates.
+
+    :param lat1: Latitudes of the first locations.
+
+    :param lon1: Longitudes of the first locations.
+
+    :param lat2: Latitudes of the second locations.
+
+    :param lon2: Longitudes of the second locations.
+
+    '''
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float))
+                              for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
 def date_to_seconds(date: str) -> float:
     ''' Convert date to seconds. '''
     return datetime.strptime(date, '%Y-%m-%d %H:%M:%S').timestamp()